@@ -22,6 +22,22 @@ default['bcpc']['cinder']['quota'] = {
 default['bcpc']['cinder']['qos']['enabled'] = false
 default['bcpc']['cinder']['qos']['volume_types'] = []
 
+# seconds the AccessFilter keeps the volume types and their access in memory
+default['bcpc']['cinder']['access_filter']['index_ttl'] = 300
+# seconds after which the access of a single project is loaded again
+default['bcpc']['cinder']['access_filter']['project_ttl'] = 30
+# seconds during which identical AccessFilter decisions are logged only once
+default['bcpc']['cinder']['access_filter']['log_interval'] = 60
+
+# BCPC backend weigher, weighing pools by capacity headroom and by their
+# latency_ms and iops capabilities; nothing in BCPC reports those, so the
+# latency, iops and stats_window settings have no effect until a driver does
+default['bcpc']['cinder']['weigher']['backend']['enabled'] = false
+default['bcpc']['cinder']['weigher']['backend']['multiplier'] = 1.0
+default['bcpc']['cinder']['weigher']['backend']['latency_limit_ms'] = 50.0
+default['bcpc']['cinder']['weigher']['backend']['iops_limit'] = 10000.0
+default['bcpc']['cinder']['weigher']['backend']['stats_window'] = 6
+
 # ceph (rbd)
 default['bcpc']['cinder']['ceph']['user'] = 'cinder'
 default['bcpc']['cinder']['ceph']['pool']['name'] = 'volumes'
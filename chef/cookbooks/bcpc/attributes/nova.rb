@@ -80,6 +80,19 @@ default['bcpc']['nova']['scheduler_default_filters'] = %w(
   ServerGroupAffinityFilter
 )
 
+# Nova scheduler weighers
+default['bcpc']['nova']['scheduler_weight_classes'] = %w(
+  nova.scheduler.weights.affinity.ServerGroupSoftAffinityWeigher
+  nova.scheduler.weights.affinity.ServerGroupSoftAntiAffinityWeigher
+  nova.scheduler.weights.bcpc_cpu.BCPCCPUWeigher
+  nova.scheduler.weights.bcpc_ram.BCPCRAMWeigher
+  nova.scheduler.weights.cross_cell.CrossCellWeigher
+  nova.scheduler.weights.disk.DiskWeigher
+  nova.scheduler.weights.io_ops.IoOpsWeigher
+  nova.scheduler.weights.metrics.MetricsWeigher
+  nova.scheduler.weights.pci.PCIWeigher
+)
+
 # per-project override quota settings
 #
 default['bcpc']['nova']['quota']['project']['admin']['ram'] = -1
@@ -110,15 +123,69 @@ default['bcpc']['nova']['db-archive']['cron_minute'] = '0'
 # select from between this many equally optimal hosts when launching an instance
 default['bcpc']['nova']['scheduler']['host_subset_size'] = 3
 
+# CPU idle signal used by the BCPC CPU weigher: raw, ewma or percentile
+default['bcpc']['nova']['scheduler']['weigher']['cpu']['idle_mode'] = 'raw'
+default['bcpc']['nova']['scheduler']['weigher']['cpu']['idle_ewma_alpha'] = 0.3
+default['bcpc']['nova']['scheduler']['weigher']['cpu']['idle_window'] = 12
+default['bcpc']['nova']['scheduler']['weigher']['cpu']['idle_percentile'] = 50
+
+# RAM signal used by the BCPC RAM weigher: allocation or pressure
+default['bcpc']['nova']['scheduler']['weigher']['ram']['mode'] = 'allocation'
+default['bcpc']['nova']['scheduler']['weigher']['ram']['iowait_limit'] = 0.2
+
+# only weigh again the hosts changed by the previous instance of a request
+default['bcpc']['nova']['scheduler']['weigher']['incremental'] = false
+
+# time the BCPC filters and weighers and trace their recent decisions,
+# written when a nova-scheduler worker receives SIGUSR1 to the dump path
+# (default $state_path/bcpc_scheduler_trace.json) with the worker pid added
+# to the file name, e.g. bcpc_scheduler_trace.1234.json
+default['bcpc']['nova']['scheduler']['instrumentation']['enabled'] = false
+default['bcpc']['nova']['scheduler']['instrumentation']['top_hosts'] = 5
+default['bcpc']['nova']['scheduler']['instrumentation']['decisions'] = 200
+default['bcpc']['nova']['scheduler']['instrumentation']['dump_path'] = nil
+
+# NUMA-aware BCPC weigher for pinned and NUMA-constrained flavors
+default['bcpc']['nova']['scheduler']['weigher']['numa']['enabled'] = false
+default['bcpc']['nova']['scheduler']['weigher']['numa']['multiplier'] = 1.0
+default['bcpc']['nova']['scheduler']['weigher']['numa']['weigherPath'] = 'nova.scheduler.weights.bcpc_numa.BCPCNUMAWeigher'
+
+# Dominant resource share BCPC weigher, replacing the CPU, RAM and disk ones
+default['bcpc']['nova']['scheduler']['weigher']['resource']['enabled'] = false
+default['bcpc']['nova']['scheduler']['weigher']['resource']['multiplier'] = 1.0
+default['bcpc']['nova']['scheduler']['weigher']['resource']['weigherPath'] = 'nova.scheduler.weights.bcpc_resource.BCPCResourceWeigher'
+default['bcpc']['nova']['scheduler']['weigher']['resource']['replaces'] = %w(
+  nova.scheduler.weights.bcpc_cpu.BCPCCPUWeigher
+  nova.scheduler.weights.bcpc_ram.BCPCRAMWeigher
+  nova.scheduler.weights.disk.DiskWeigher
+)
+
+# Anti-affinity availability zone scheduler weigher, ranking hosts by the
+# number of server group members in their availability zone. Unlike the
+# filter it never fails a request, and it also applies to soft-anti-affinity
+# server groups.
+default['bcpc']['nova']['scheduler']['weigher']['anti_affinity_availability_zone']['enabled'] = false
+default['bcpc']['nova']['scheduler']['weigher']['anti_affinity_availability_zone']['multiplier'] = 1.0
+default['bcpc']['nova']['scheduler']['weigher']['anti_affinity_availability_zone']['weigherPath'] = 'nova.scheduler.weights.anti_affinity_availability_zone_weigher.AntiAffinityAvailabilityZoneWeigher'
+
 # Anti-affinity availability zone scheduler filter
 default['bcpc']['nova']['scheduler']['filter']['anti_affinity_availability_zone']['enabled'] = false
 default['bcpc']['nova']['scheduler']['filter']['anti_affinity_availability_zone']['name'] = 'AntiAffinityAvailabilityZoneFilter'
 default['bcpc']['nova']['scheduler']['filter']['anti_affinity_availability_zone']['filterPath'] = 'nova.scheduler.filters.anti_affinity_availability_zone_filter.AntiAffinityAvailabilityZoneFilter'
+# seconds the host to availability zone map is cached for
+default['bcpc']['nova']['scheduler']['filter']['anti_affinity_availability_zone']['az_map_ttl'] = 300
+# forbid the aggregates of the zones a server group is in to placement, so
+# the filter is only run on hosts of the other zones
+default['bcpc']['nova']['scheduler']['filter']['anti_affinity_availability_zone']['prefilter'] = false
 
 # Required image property scheduler filter
 default['bcpc']['nova']['scheduler']['filter']['required_image_property']['enabled'] = false
 default['bcpc']['nova']['scheduler']['filter']['required_image_property']['name'] = 'RequiredImagePropertyFilter'
 default['bcpc']['nova']['scheduler']['filter']['required_image_property']['filterPath'] = 'nova.scheduler.filters.required_image_property_filter.RequiredImagePropertyFilter'
+# check the license trait of the image before querying placement
+default['bcpc']['nova']['scheduler']['filter']['required_image_property']['prefilter'] = false
+# file listing the license traits, read again by the filter when it changes
+default['bcpc']['nova']['scheduler']['filter']['required_image_property']['license_traits_file'] = '/etc/nova/license-traits'
 
 # aggregate image properties isolation
 default['bcpc']['nova']['scheduler']['filter']['aggregate_image_isolation']['name'] = 'AggregateImagePropertiesIsolation'
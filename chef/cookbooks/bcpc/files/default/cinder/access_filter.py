@@ -12,19 +12,309 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import time
+
+from oslo_config import cfg
 from oslo_log import log as logging
+import oslo_messaging as messaging
+from sqlalchemy import sql
 
 from cinder import context
-from cinder import db
+from cinder.db.sqlalchemy import api as db_api
+from cinder.db.sqlalchemy import models
+from cinder import rpc
 from cinder.scheduler import filters
+from cinder import utils
 from cinder.volume import volume_types
 
 
 LOG = logging.getLogger(__name__)
 
+access_filter_opts = [
+    cfg.IntOpt('index_ttl',
+               default=300,
+               min=0,
+               help='Seconds after which the volume types and the private '
+                    'types every project can access are loaded again. '
+                    'They are also loaded again when a volume type or '
+                    'volume type access notification is received.'),
+    cfg.IntOpt('project_ttl',
+               default=30,
+               min=0,
+               help='Seconds after which the private types a project can '
+                    'access are loaded again for that project alone, so '
+                    'access added or removed is seen without waiting for '
+                    'index_ttl. Each project is loaded at most once in that '
+                    'time.'),
+    cfg.IntOpt('log_interval',
+               default=60,
+               min=0,
+               help='Seconds during which identical filter decisions are '
+                    'only logged once. The time spent filtering is also '
+                    'logged at that interval.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(access_filter_opts, group='access_filter')
+
+
+def volume_type_access_get_all_private(context, project_id=None):
+    """Return the name and project id of every private volume type access.
+
+    A single query joining volume_types and volume_type_projects, instead of
+    reading the access list of every private type one at a time. The access
+    is limited to a single project if project_id is given.
+    """
+    session = db_api.get_session()
+    with session.begin():
+        query = session.query(
+            models.VolumeType.name, models.VolumeTypeProjects.project_id,
+        ).join(
+            models.VolumeTypeProjects,
+            models.VolumeTypeProjects.volume_type_id == models.VolumeType.id,
+        ).filter(
+            models.VolumeType.is_public == sql.false(),
+            models.VolumeType.deleted == sql.false(),
+            models.VolumeTypeProjects.deleted == 0,
+        )
+        if project_id is not None:
+            query = query.filter(
+                models.VolumeTypeProjects.project_id == project_id)
+        return query.all()
+
+
+class AccessIndex(object):
+    """Volume types and the private types every project can access.
+
+    The index is shared by the AccessFilter instances, which cinder creates
+    for every request, so checking a backend is a set lookup instead of
+    database queries. It is loaded again once index_ttl expired or when a
+    notification tells that volume types or their access changed. As BCPC
+    does not enable notifications, the access of a project is also loaded
+    again on its own once project_ttl expired for it.
+    """
+
+    def __init__(self):
+        self._backend_types = None
+        self._project_types = None
+        # project id -> (time loaded, names) of the projects loaded alone
+        self._reloaded_project_types = {}
+        self._loaded = 0
+        self._expires = 0
+        self._generation = 0
+        self._listener = None
+
+    def invalidate(self):
+        self._generation += 1
+        self._expires = 0
+
+    def _refresh(self):
+        generation = self._generation
+        loaded = time.monotonic()
+        admin_context = context.get_admin_context()
+
+        backend_types = {}
+        for name, backend_type in volume_types.get_all_types(
+                admin_context).items():
+            backend_types[name] = {'id': backend_type['id'],
+                                   'is_public': backend_type['is_public']}
+
+        project_types = collections.defaultdict(set)
+        for name, project_id in volume_type_access_get_all_private(
+                admin_context):
+            project_types[project_id].add(name)
+
+        self._backend_types = backend_types
+        self._project_types = {project_id: frozenset(names)
+                               for project_id, names in project_types.items()}
+        self._reloaded_project_types = {}
+        self._loaded = loaded
+        # load again on next use if invalidated while loading
+        if generation == self._generation:
+            self._expires = time.monotonic() + CONF.access_filter.index_ttl
+        LOG.debug("access index loaded with %(types)d volume types and "
+                  "%(projects)d projects",
+                  {'types': len(backend_types),
+                   'projects': len(project_types)})
+
+    def _lookup(self):
+        if self._listener is None:
+            self._start_listener()
+        if self._backend_types is None or time.monotonic() >= self._expires:
+            self._refresh()
+
+    def _start_listener(self):
+        """Invalidate the index on volume type notifications, if enabled."""
+        self._listener = False
+        if (rpc.NOTIFICATION_TRANSPORT is None or
+                not utils.notifications_enabled(CONF)):
+            return
+
+        # a pool of its own per scheduler, so that every scheduler gets
+        # every notification and none is taken from other consumers
+        targets = [messaging.Target(topic=topic) for topic in
+                   CONF.oslo_messaging_notifications.topics]
+        try:
+            listener = messaging.get_notification_listener(
+                rpc.NOTIFICATION_TRANSPORT, targets,
+                [AccessNotificationEndpoint(self)],
+                executor='threading', pool='access-filter-%s' % CONF.host)
+            listener.start()
+        except Exception:
+            LOG.exception("unable to listen to volume type notifications, "
+                          "the access index is only loaded every %d seconds",
+                          CONF.access_filter.index_ttl)
+            return
+        self._listener = listener
+
+    def backend_type(self, backend_type_name):
+        """Return the id and is_public flag of a volume type, or None."""
+        self._lookup()
+        return self._backend_types.get(backend_type_name)
+
+    def project_types(self, project_id):
+        """Return the names of the private types a project can access.
+
+        The access of the project is loaded again from the database if it
+        was loaded more than project_ttl seconds ago.
+        """
+        self._lookup()
+        reloaded = self._reloaded_project_types.get(project_id)
+        if reloaded is not None:
+            loaded, names = reloaded
+        else:
+            loaded = self._loaded
+            names = self._project_types.get(project_id, frozenset())
+
+        now = time.monotonic()
+        if now - loaded < CONF.access_filter.project_ttl:
+            return names
+
+        reloaded_names = frozenset(
+            name for name, _project_id in volume_type_access_get_all_private(
+                context.get_admin_context(), project_id))
+        if reloaded_names != names:
+            LOG.debug("access of project %(project)s changed since it was "
+                      "loaded", {'project': project_id})
+        self._reloaded_project_types[project_id] = (now, reloaded_names)
+        return reloaded_names
+
+
+class AccessNotificationEndpoint(object):
+    """Invalidate the access index when volume types or access change."""
+
+    filter_rule = messaging.NotificationFilter(
+        event_type=r'^volume_type(_project)?\.')
+
+    def __init__(self, index):
+        self._index = index
+
+    def info(self, ctxt, publisher_id, event_type, payload, metadata):
+        LOG.debug("%s received, invalidating the access index", event_type)
+        self._index.invalidate()
+
+
+ACCESS_INDEX = AccessIndex()
+
+
+class DecisionLog(object):
+    """Log the decisions of the filter at most once per log_interval.
+
+    Decisions are rate limited by key, the whole content of a request
+    summary or the reason of an error, and the number of decisions left out
+    is added to the next one logged with the same key. The time spent in the
+    filter is accumulated and logged at the same interval.
+    """
+
+    def __init__(self):
+        self._logged = {}
+        self._suppressed = collections.Counter()
+        self.calls = 0
+        self.backends = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+    def log(self, level, key, msg, args=None):
+        now = time.monotonic()
+        interval = CONF.access_filter.log_interval
+        last = self._logged.get(key)
+        if last is not None and now - last < interval:
+            self._suppressed[key] += 1
+            return
+
+        # forget the keys not logged for an interval, projects come and go
+        if len(self._logged) > 1024:
+            self._logged = {k: t for k, t in self._logged.items()
+                            if now - t < interval or k in self._suppressed}
+        self._logged[key] = now
+        suppressed = self._suppressed.pop(key, 0)
+        if suppressed:
+            msg += " (%(suppressed)d identical decisions not logged)"
+            args = dict(args or {}, suppressed=suppressed)
+        if args:
+            LOG.log(level, msg, args)
+        else:
+            LOG.log(level, msg)
+
+    def record_timing(self, backends, seconds):
+        self.calls += 1
+        self.backends += backends
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+        self.log(logging.INFO, 'timing',
+                 "access filter ran %(calls)d times on %(backends)d "
+                 "backends in %(seconds).3fs, at most %(max).1fms a request",
+                 {'calls': self.calls, 'backends': self.backends,
+                  'seconds': self.seconds,
+                  'max': self.max_seconds * 1000})
+
+
+DECISION_LOG = DecisionLog()
+
 
 class AccessFilter(filters.BaseBackendFilter):
 
+    def __init__(self):
+        super(AccessFilter, self).__init__()
+        # cinder creates the filter for every request
+        self._project_id = None
+        self._project_types = None
+        # decisions of the request, summarized once it is filtered
+        self._accepted = []
+        self._rejected = collections.defaultdict(list)
+
+    def filter_all(self, filter_obj_list, filter_properties):
+        start = time.monotonic()
+        backends = list(filter_obj_list)
+        passed = list(super(AccessFilter, self).filter_all(
+            backends, filter_properties))
+        DECISION_LOG.record_timing(len(backends), time.monotonic() - start)
+
+        if self._accepted or self._rejected:
+            project = getattr(filter_properties.get('context'),
+                              'project_id', None)
+            accepted = sorted(set(self._accepted))
+            rejected = {reason: sorted(set(names)) for reason, names
+                        in sorted(self._rejected.items())}
+            # only the same summary for the same project is rate limited
+            key = (project, tuple(accepted),
+                   tuple((reason, tuple(names))
+                         for reason, names in rejected.items()))
+            DECISION_LOG.log(
+                logging.INFO, key,
+                "access filter decision for project %(project)s: "
+                "accepted %(accepted)s, rejected %(rejected)s",
+                {'project': project,
+                 'accepted': accepted,
+                 'rejected': rejected})
+        return iter(passed)
+
+    def _reject(self, backend_type_name, reason):
+        self._rejected[reason].append(backend_type_name)
+        return False
+
     def backend_passes(self, backend_state, filter_properties):
         # get the volume type from the filter properties or return None
         volume_type = filter_properties.get('volume_type', None)
@@ -42,7 +332,8 @@ class AccessFilter(filters.BaseBackendFilter):
 
         # we can't do anything without the request context
         if r_context is None:
-            LOG.fatal("context not found in filter_properties")
+            DECISION_LOG.log(logging.ERROR, 'no context',
+                             "context not found in filter_properties")
             return False
 
         # get the project id from the request context
@@ -53,53 +344,31 @@ class AccessFilter(filters.BaseBackendFilter):
 
         # we can't do anything without a project id
         if project_id is None:
-            LOG.fatal("project id not found in the request context")
+            DECISION_LOG.log(logging.ERROR, 'no project',
+                             "project id not found in the request context")
             return False
 
-        # we need the admin context to fetch the list of backend types
-        # and access ids
-        admin_context = context.get_admin_context()
-
-        # get all backend types
-        backend_types = volume_types.get_all_types(admin_context)
-
         # get the type name from the backend state
         backend_type_name = backend_state.pool_name
 
         # get backend state information
-        backend_type_info = backend_types.get(backend_type_name)
+        backend_type_info = ACCESS_INDEX.backend_type(backend_type_name)
 
         # we can't do anything without the backend type information
         if backend_type_info is None:
-            LOG.info(
-                "no backend type information found for {}. "
-                "skipping".format(backend_type_name))
-            return False
+            return self._reject(backend_type_name, 'no backend type')
 
         # we're only looking for private backend types
         if backend_type_info['is_public']:
-            LOG.info(
-                "backend type {} is not private. "
-                "skipping".format(backend_type_name))
-            return False
-
-        # get the backend type id
-        backend_type_id = backend_type_info['id']
-
-        # get list of access ids for current backend type
-        backend_type_access = db.volume_type_access_get_all(
-            admin_context, backend_type_id)
+            return self._reject(backend_type_name, 'not private')
 
-        # look for project id in list of access ids
-        backend_type_found = [access for access in backend_type_access
-                              if access.project_id == project_id]
-
-        if len(backend_type_found) > 0:
-            LOG.info("{} is a valid backend type".format(backend_type_name))
+        # look for the backend type in the private types of the project,
+        # resolved once per request
+        if self._project_id != project_id:
+            self._project_id = project_id
+            self._project_types = ACCESS_INDEX.project_types(project_id)
+        if backend_type_name in self._project_types:
+            self._accepted.append(backend_type_name)
             return True
 
-        LOG.info(
-            "could not find project id {} in the {} backend type. "
-            "skipping".format(project_id, backend_type_name))
-
-        return False
+        return self._reject(backend_type_name, 'no project access')
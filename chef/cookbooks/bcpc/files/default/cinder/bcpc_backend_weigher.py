@@ -0,0 +1,157 @@
+# Copyright 2024, Bloomberg Finance L.P.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+BCPC Backend Weigher.  Weigh pools by their capacity headroom and load.
+
+The AccessFilter decides which private pools a project can use, and the
+CapacityWeigher then only picks the emptiest of them. This weigher weighs a
+pool by the smallest of its free capacity and provisioned capacity headroom,
+lowered by how loaded the pool recently was.
+
+The load is the latency and IOPS the backend reports in the latency_ms and
+iops capabilities of its pools, averaged over the last samples of every
+pool. Neither the RBD driver nor anything else in BCPC reports these
+capabilities, so the load term is inactive as shipped and pools are only
+weighed by capacity headroom until a driver reports them.
+"""
+
+import collections
+
+from oslo_config import cfg
+
+from cinder.scheduler import weights
+
+
+bcpc_backend_weight_opts = [
+    cfg.FloatOpt('bcpc_backend_weight_multiplier',
+                 default=1.0,
+                 help='Multiplier used for weighing pools by capacity '
+                      'headroom and load.'),
+    cfg.FloatOpt('bcpc_backend_latency_limit_ms',
+                 default=50.0,
+                 min=0.001,
+                 help='Latency at which a pool gets the largest load '
+                      'penalty.'),
+    cfg.FloatOpt('bcpc_backend_iops_limit',
+                 default=10000.0,
+                 min=1.0,
+                 help='IOPS at which a pool gets the largest load penalty.'),
+    cfg.IntOpt('bcpc_backend_stats_window',
+               default=6,
+               min=1,
+               help='Number of latency and IOPS samples averaged per pool.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(bcpc_backend_weight_opts)
+
+LATENCY_MS = 'latency_ms'
+IOPS = 'iops'
+
+
+class PoolStats(object):
+    """Rolling window of the latency and IOPS reported by every pool.
+
+    A sample is only added once per capability report of a pool, keyed on
+    the timestamp the scheduler stamps the report with. The updated time of
+    the backend state is not used, as consume_from_volume moves it on every
+    volume placed on the pool.
+    """
+
+    def __init__(self):
+        self._samples = {}
+        self._reported = {}
+
+    def add(self, backend_state):
+        pool = backend_state.backend_id
+        capabilities = backend_state.capabilities or {}
+        reported = capabilities.get('timestamp')
+        if reported is None or self._reported.get(pool) == reported:
+            return
+        self._reported[pool] = reported
+
+        if LATENCY_MS not in capabilities and IOPS not in capabilities:
+            return
+
+        samples = self._samples.get(pool)
+        if (samples is None or
+                samples.maxlen != CONF.bcpc_backend_stats_window):
+            samples = collections.deque(
+                samples or (), maxlen=CONF.bcpc_backend_stats_window)
+            self._samples[pool] = samples
+        samples.append((float(capabilities.get(LATENCY_MS) or 0),
+                        float(capabilities.get(IOPS) or 0)))
+
+    def mean(self, pool):
+        """Return the mean latency and IOPS of a pool, or None."""
+        samples = self._samples.get(pool)
+        if not samples:
+            return None
+        return (sum(s[0] for s in samples) / len(samples),
+                sum(s[1] for s in samples) / len(samples))
+
+
+POOL_STATS = PoolStats()
+
+
+class BCPCBackendWeigher(weights.BaseHostWeigher):
+    minval = 0
+    maxval = 1
+
+    def weight_multiplier(self):
+        """Override the weight multiplier."""
+        return CONF.bcpc_backend_weight_multiplier
+
+    def _weigh_object(self, host_state, weight_properties):
+        """Higher weights win.  We want spreading to be the default."""
+        POOL_STATS.add(host_state)
+
+        headroom = _capacity_headroom(host_state)
+        if headroom <= 0:
+            return 0
+
+        load = 0
+        stats = POOL_STATS.mean(host_state.backend_id)
+        if stats is not None:
+            latency_ms, iops = stats
+            load = min(max(latency_ms / CONF.bcpc_backend_latency_limit_ms,
+                           iops / CONF.bcpc_backend_iops_limit), 1)
+
+        return headroom * (1 - load)
+
+
+def _capacity_headroom(host_state):
+    """Return the fraction of a pool still free to provision.
+
+    This is the smallest of the free capacity, less the reserved space, and
+    of the capacity left under the over subscription ratio for thin pools.
+    """
+    total = host_state.total_capacity_gb
+    free = host_state.free_capacity_gb
+    if total in ('infinite', 'unknown') or free in ('infinite', 'unknown'):
+        return 0
+    total = float(total)
+    if total <= 0:
+        return 0
+
+    reserved = total * host_state.reserved_percentage / 100.0
+    headroom = (float(free) - reserved) / total
+
+    if host_state.thin_provisioning_support:
+        ratio = float(host_state.max_over_subscription_ratio or 1)
+        provisioned = float(host_state.provisioned_capacity_gb or 0)
+        headroom = min(headroom, 1 - provisioned / (total * ratio))
+
+    return max(headroom, 0)
@@ -15,7 +15,12 @@
 NOTE: This module is a temporary shim until networking projects move to
       versioned objects at which point this module shouldn't be needed.
 """
+import collections
+import weakref
+
 from oslo_db.sqlalchemy import utils as sa_utils
+import sqlalchemy as sa
+from sqlalchemy import orm
 from sqlalchemy.orm import lazyload
 from sqlalchemy import sql, or_, and_
 
@@ -25,7 +30,6 @@ from neutron_lib import constants
 from neutron_lib.db import utils as db_utils
 from neutron_lib import exceptions as n_exc
 from neutron_lib.objects import utils as obj_utils
-from neutron_lib.utils import helpers
 
 
 # Classes implementing extensions will register hooks into this dictionary
@@ -61,6 +65,78 @@ _model_query_hooks = {
     # ...
 }
 
+# The hooks of every model grouped by kind, only keeping the kinds a hook
+# implements. Built from _model_query_hooks on first use and dropped whenever
+# a hook is registered or one of the registered hooks is garbage collected.
+_ResolvedHooks = collections.namedtuple(
+    '_ResolvedHooks', ['query', 'filter', 'rbac_filter', 'result_filters'])
+_resolved_hooks = {}
+_resolved_hooks_source = None
+
+# Skeletons of the scoped queries of every model, keyed on the model, the
+# queried field and whether the query is scoped to a project. The project is
+# a bound parameter, so one skeleton serves the queries of every project and
+# only the session of the request has to be bound to it.
+_ScopedQuery = collections.namedtuple(
+    '_ScopedQuery', ['query', 'query_to_union', 'model_query_filter',
+                     'rbac_query_filter', 'query_filter'])
+_scoped_queries = {}
+
+# Name of the parameter the project of a scoped query is bound to.
+_PROJECT_PARAM = 'model_query_project_id'
+
+# Number of objects get_collection_chunks() loads per query.
+COLLECTION_CHUNK_SIZE = 500
+
+
+def _invalidate_resolved_hooks(ref=None):
+    _resolved_hooks.clear()
+
+
+def _make_weak_ref(f):
+    """Make a weak reference to a hook, see helpers.make_weak_ref.
+
+    The resolved hooks are dropped once the hook is garbage collected.
+    """
+    if hasattr(f, '__self__'):
+        return weakref.WeakMethod(f, _invalidate_resolved_hooks)
+    return weakref.ref(f, _invalidate_resolved_hooks)
+
+
+def _make_resolver(ref):
+    """Return a callable resolving a hook, None if the hook is gone."""
+    if isinstance(ref, weakref.ref):
+        return ref if ref() is not None else None
+    if ref is not None:
+        return lambda: ref
+
+
+def _get_resolved_hooks(model):
+    """Retrieve the model query hooks for a model, grouped by kind.
+
+    Every kind is a list of resolvers, the weak references registered for
+    the hooks, so the query path neither walks the hook dicts nor checks for
+    the kinds a hook does not implement.
+
+    :param model: The DB Model to look up for query hooks.
+    :returns: a _ResolvedHooks of lists of resolvers
+    """
+    global _resolved_hooks_source
+    if _resolved_hooks_source is not _model_query_hooks:
+        # the hooks were replaced as a whole, e.g. by DBQueryHooksFixture
+        _resolved_hooks.clear()
+        _resolved_hooks_source = _model_query_hooks
+    resolved = _resolved_hooks.get(model)
+    if resolved is None:
+        resolved = _ResolvedHooks([], [], [], [])
+        for hook in get_hooks(model):
+            for kind, resolvers in zip(_ResolvedHooks._fields, resolved):
+                resolver = _make_resolver(hook.get(kind))
+                if resolver is not None:
+                    resolvers.append(resolver)
+        _resolved_hooks[model] = resolved
+    return resolved
+
 
 def register_hook(model, name, query_hook, filter_hook,
                   result_filters=None, rbac_filter_hook=None):
@@ -78,19 +154,20 @@ def register_hook(model, name, query_hook, filter_hook,
     :returns: None.
     """
     if callable(query_hook):
-        query_hook = helpers.make_weak_ref(query_hook)
+        query_hook = _make_weak_ref(query_hook)
     if callable(filter_hook):
-        filter_hook = helpers.make_weak_ref(filter_hook)
+        filter_hook = _make_weak_ref(filter_hook)
     if callable(result_filters):
-        result_filters = helpers.make_weak_ref(result_filters)
+        result_filters = _make_weak_ref(result_filters)
     if callable(rbac_filter_hook):
-        rbac_filter_hook = helpers.make_weak_ref(rbac_filter_hook)
+        rbac_filter_hook = _make_weak_ref(rbac_filter_hook)
     _model_query_hooks.setdefault(model, {})[name] = {
         'query': query_hook,
         'filter': filter_hook,
         'result_filters': result_filters,
         'rbac_filter': rbac_filter_hook,
     }
+    _invalidate_resolved_hooks()
 
 
 def get_hooks(model):
@@ -108,7 +185,7 @@ def _prep_query_with_hooks(context, model, field):
     :param context: The context to use for the DB session.
     :param model: The model to query.
     :param field: The column.
-    :returns: The query with hooks applied to it.
+    :returns: The query, not bound to the session of the context.
     """
     if field:
         if hasattr(model, field):
@@ -116,54 +193,108 @@ def _prep_query_with_hooks(context, model, field):
         else:
             msg = _("'%s' is not supported as field") % field
             raise n_exc.InvalidInput(error_message=msg)
-        return context.session.query(field)
-    return context.session.query(model)
+        query = context.session.query(field)
+    else:
+        query = context.session.query(model)
+    # keep the query class of the session, but not the session itself
+    return query.with_session(None)
 
 
-def query_with_hooks(context, model, field=None, lazy_fields=None,
-                     hoisted_filters=None):
-    """Query with hooks using the said context and model.
+def _get_scoped_query(context, model, field, project_scope):
+    """Retrieve the skeleton of a query, built on first use.
 
     :param context: The context to use for the DB session.
     :param model: The model to query.
     :param field: The column.
-    :param lazy_fields: list of fields for lazy loading
-    :returns: The query with hooks applied to it.
+    :param project_scope: Whether the query is scoped to a project.
+    :returns: a _ScopedQuery, the project being bound to _PROJECT_PARAM
     """
+    key = (model, field, project_scope)
+    scoped = _scoped_queries.get(key)
+    if scoped is not None:
+        return scoped
+
     query = _prep_query_with_hooks(context, model, field)
     query_to_union = None
-    # define basic filter condition for model query
     query_filter = None
     model_query_filter, rbac_query_filter = None, None
-    if db_utils.model_query_scope_is_project(context, model):
+    if project_scope:
+        project_id = sql.bindparam(_PROJECT_PARAM)
         if hasattr(model, 'rbac_entries'):
             query = query.join(model.rbac_entries)
             query_to_union = _prep_query_with_hooks(context, model, field)
             rbac_model = model.rbac_entries.property.mapper.class_
-            model_query_filter = (model.tenant_id == context.tenant_id)
+            model_query_filter = (model.tenant_id == project_id)
             rbac_query_filter = (
                 (rbac_model.action.in_(
                     [constants.ACCESS_SHARED, constants.ACCESS_READONLY]) &
-                 ((rbac_model.target_project == context.tenant_id) |
+                 ((rbac_model.target_project == project_id) |
                   (rbac_model.target_project == '*'))))
         elif hasattr(model, 'shared'):
-            query_filter = ((model.tenant_id == context.tenant_id) |
+            query_filter = ((model.tenant_id == project_id) |
                             (model.shared == sql.true()))
         else:
-            query_filter = (model.tenant_id == context.tenant_id)
-    # Execute query hooks registered from mixins and plugins
-    for hook in get_hooks(model):
-        query_hook = helpers.resolve_ref(hook.get('query'))
-        if query_hook:
-            query = query_hook(context, model, query)
+            query_filter = (model.tenant_id == project_id)
+
+    scoped = _ScopedQuery(query, query_to_union, model_query_filter,
+                          rbac_query_filter, query_filter)
+    _scoped_queries[key] = scoped
+    return scoped
+
 
-        filter_hook = helpers.resolve_ref(hook.get('filter'))
+def _run_filter_hooks(context, model, hooks, query_filter, rbac_query_filter):
+    """Run the filter and rbac_filter hooks of a model.
+
+    :param context: The context to use for the DB session.
+    :param model: The model to query.
+    :param hooks: The _ResolvedHooks of the model.
+    :param query_filter: The filter condition of the query.
+    :param rbac_query_filter: The filter condition on the RBAC entries.
+    :returns: The query_filter and rbac_query_filter with hooks applied.
+    """
+    for resolver in hooks.filter:
+        filter_hook = resolver()
         if filter_hook:
             query_filter = filter_hook(context, model, query_filter)
 
-        filter_hook = helpers.resolve_ref(hook.get('rbac_filter'))
+    for resolver in hooks.rbac_filter:
+        filter_hook = resolver()
         if filter_hook:
             rbac_query_filter = filter_hook(context, model, rbac_query_filter)
+    return query_filter, rbac_query_filter
+
+
+def query_with_hooks(context, model, field=None, lazy_fields=None,
+                     hoisted_filters=None):
+    """Query with hooks using the said context and model.
+
+    :param context: The context to use for the DB session.
+    :param model: The model to query.
+    :param field: The column.
+    :param lazy_fields: list of fields for lazy loading
+    :returns: The query with hooks applied to it.
+    """
+    # define basic filter condition for model query
+    project_scope = db_utils.model_query_scope_is_project(context, model)
+    scoped = _get_scoped_query(context, model, field, project_scope)
+    query = scoped.query.with_session(context.session)
+    query_to_union = scoped.query_to_union
+    if query_to_union is not None:
+        query_to_union = query_to_union.with_session(context.session)
+    query_filter = scoped.query_filter
+    model_query_filter = scoped.model_query_filter
+    rbac_query_filter = scoped.rbac_query_filter
+    # Execute query hooks registered from mixins and plugins
+    # NOTE: the query, filter and rbac_filter hooks each build their own part
+    # of the query, so running them kind by kind keeps the hook order.
+    hooks = _get_resolved_hooks(model)
+    for resolver in hooks.query:
+        query_hook = resolver()
+        if query_hook:
+            query = query_hook(context, model, query)
+
+    query_filter, rbac_query_filter = _run_filter_hooks(
+        context, model, hooks, query_filter, rbac_query_filter)
 
     # NOTE(tstachecki): this code used to live in apply_filters(...), but
     # we have to evaluate it here before we union off the RBAC columns.
@@ -235,6 +366,8 @@ def query_with_hooks(context, model, field=None, lazy_fields=None,
     if lazy_fields:
         for field in lazy_fields:
             query = query.options(lazyload(field))
+    if project_scope:
+        query = query.params({_PROJECT_PARAM: context.tenant_id})
     return query
 
 
@@ -296,9 +429,8 @@ def apply_filters(query, model, filters, context=None):
                         query = query.filter(column.in_(value))
                     except NotImplementedError:
                         pass
-        for hook in get_hooks(model):
-            result_filter = helpers.resolve_ref(
-                hook.get('result_filters', None))
+        for resolver in _get_resolved_hooks(model).result_filters:
+            result_filter = resolver()
             if result_filter:
                 query = result_filter(query, filters)
     return query
@@ -306,7 +438,7 @@ def apply_filters(query, model, filters, context=None):
 
 def get_collection_query(context, model, filters=None, sorts=None, limit=None,
                          marker_obj=None, page_reverse=False, field=None,
-                         lazy_fields=None):
+                         lazy_fields=None, load_columns=None):
     """Get a collection query.
 
     :param context: The context to use for the DB session.
@@ -319,11 +451,15 @@ def get_collection_query(context, model, filters=None, sorts=None, limit=None,
     :param field: Column, in string format, from the "model"; the query will
                   return only this parameter instead of the full model columns.
     :param lazy_fields: list of fields for lazy loading
+    :param load_columns: list of the only columns to load, see
+                         get_field_projection()
     :returns: A paginated query for the said model.
     """
     collection = query_with_hooks(context, model, field=field,
                                   lazy_fields=lazy_fields,
                                   hoisted_filters=filters)
+    if load_columns:
+        collection = collection.options(orm.load_only(*load_columns))
     collection = apply_filters(collection, model, filters, context)
     if sorts:
         sort_keys = db_utils.get_and_validate_sort_keys(sorts, model)
@@ -345,6 +481,40 @@ def get_collection_query(context, model, filters=None, sorts=None, limit=None,
     return collection
 
 
+def get_field_projection(model, fields):
+    """Translate the fields to collect into the parts of a model to load.
+
+    Only the columns backing the fields are loaded, along with the primary
+    key, and the relationships eagerly loaded by the model but not part of
+    the fields are loaded lazily. Fields not backed by a column or a
+    relationship of the model, e.g. the ones computed by dict functions or
+    extensions, cannot be projected.
+
+    :param model: The model for the collection.
+    :param fields: The fields to collect.
+    :returns: A tuple of the columns to load and the relationships to load
+              lazily, None if the fields cannot be projected.
+    """
+    mapper = sa.inspect(model)
+    columns, relationships = set(), set()
+    for field in fields:
+        prop = mapper.attrs.get(field)
+        if isinstance(prop, orm.SynonymProperty):
+            prop = mapper.attrs.get(prop.name)
+        if isinstance(prop, orm.ColumnProperty):
+            columns.add(prop.key)
+        elif isinstance(prop, orm.RelationshipProperty):
+            relationships.add(prop.key)
+        else:
+            return None
+    load_columns = [getattr(model, key) for key in sorted(columns)]
+    lazy_fields = [
+        getattr(model, rel.key) for rel in mapper.relationships
+        if rel.key not in relationships and
+        rel.lazy in ('joined', 'subquery', 'selectin', False)]
+    return load_columns, lazy_fields
+
+
 def _unique_keys(model):
     # just grab first set of unique keys and use them.
     # if model has no unqiue sets, 'paginate_query' will
@@ -353,10 +523,22 @@ def _unique_keys(model):
     return uk_sets[0] if uk_sets else []
 
 
+def _project_fields(model, fields, lazy_fields, field_projection):
+    """Return the lazy fields and columns to load for get_collection."""
+    projection = None
+    if field_projection and fields:
+        projection = get_field_projection(model, fields)
+    if not projection:
+        return lazy_fields, None
+    load_columns, projected_lazy_fields = projection
+    return list(lazy_fields or []) + projected_lazy_fields, load_columns
+
+
 def get_collection(context, model, dict_func,
                    filters=None, fields=None,
                    sorts=None, limit=None, marker_obj=None,
-                   page_reverse=False, lazy_fields=None):
+                   page_reverse=False, lazy_fields=None,
+                   field_projection=False):
     """Get a collection for a said model.
 
     :param context: The context to use for the DB session.
@@ -369,13 +551,21 @@ def get_collection(context, model, dict_func,
     :param marker_obj: The marker object if applicable.
     :param page_reverse: If reverse paging should be used.
     :param lazy_fields: list of fields for lazy loading
+    :param field_projection: If only the columns and relationships backing
+                             the fields should be loaded, see
+                             get_field_projection(). Only for dict functions
+                             not reading other attributes of the objects,
+                             which would be loaded one object at a time.
     :returns: A list of dicts where each dict is an object in the collection.
     """
+    lazy_fields, load_columns = _project_fields(
+        model, fields, lazy_fields, field_projection)
     query = get_collection_query(context, model,
                                  filters=filters, sorts=sorts,
                                  limit=limit, marker_obj=marker_obj,
                                  page_reverse=page_reverse,
-                                 lazy_fields=lazy_fields)
+                                 lazy_fields=lazy_fields,
+                                 load_columns=load_columns)
     items = [
         attributes.populate_project_info(
             dict_func(c, fields) if dict_func else c)
@@ -386,6 +576,85 @@ def get_collection(context, model, dict_func,
     return items
 
 
+def get_collection_chunks(context, model, dict_func,
+                          filters=None, fields=None,
+                          sorts=None, limit=None, marker_obj=None,
+                          page_reverse=False, lazy_fields=None,
+                          field_projection=False,
+                          chunk_size=COLLECTION_CHUNK_SIZE):
+    """Get a collection for a said model, one chunk at a time.
+
+    Unlike get_collection, the collection is not loaded at once. It is paged
+    through with queries of at most chunk_size objects, each one resuming
+    after the last object of the previous one, so only a chunk of ORM objects
+    is held at a time and the caller can serialize the chunks as they come.
+    The caller has to keep its DB transaction open while iterating to get a
+    consistent view of the collection.
+
+    :param context: The context to use for the DB session.
+    :param model: The model for the collection.
+    :param dict_func: The function used to build the collection dict.
+    :param filters: The filters to apply.
+    :param fields: The fields to collect.
+    :param sorts: The sort keys to use, the unique keys of the model if none.
+    :param limit: The number of objects to return if applicable. Unlike the
+                  limit of get_collection, it is not lowered by objects
+                  returned in several rows.
+    :param marker_obj: The marker object if applicable.
+    :param page_reverse: If reverse paging should be used.
+    :param lazy_fields: list of fields for lazy loading
+    :param field_projection: If only the columns and relationships backing
+                             the fields should be loaded, see get_collection.
+    :param chunk_size: The number of objects to load per query.
+    :returns: A generator of lists of dicts, where each dict is an object in
+              the collection.
+    """
+    if not sorts:
+        sorts = [(key, True) for key in sorted(_unique_keys(model))]
+    if (limit and page_reverse) or not sorts:
+        # NOTE: a reversed page is returned last object first and a model
+        # without unique keys cannot be paged through, so these are loaded
+        # as a whole.
+        items = get_collection(context, model, dict_func,
+                               filters=filters, fields=fields,
+                               sorts=sorts, limit=limit,
+                               marker_obj=marker_obj,
+                               page_reverse=page_reverse,
+                               lazy_fields=lazy_fields,
+                               field_projection=field_projection)
+        for i in range(0, len(items), chunk_size):
+            yield items[i:i + chunk_size]
+        return
+
+    lazy_fields, load_columns = _project_fields(
+        model, fields, lazy_fields, field_projection)
+    while True:
+        size = min(chunk_size, limit) if limit else chunk_size
+        query = get_collection_query(context, model,
+                                     filters=filters, sorts=sorts,
+                                     limit=size, marker_obj=marker_obj,
+                                     page_reverse=page_reverse,
+                                     lazy_fields=lazy_fields,
+                                     load_columns=load_columns)
+        objects = query.all()
+        if not objects:
+            return
+        yield [
+            attributes.populate_project_info(
+                dict_func(c, fields) if dict_func else c)
+            for c in objects
+        ]
+        # NOTE: the rows of an object joined to several RBAC entries are
+        # returned as one object, so a short chunk does not mean that the
+        # collection is exhausted, only an empty one does.
+        if limit == len(objects):
+            return
+        if limit:
+            limit -= len(objects)
+        marker_obj = objects[-1]
+        del objects
+
+
 def get_values(context, model, field, filters=None):
     query = query_with_hooks(context, model, field=field,
                              hoisted_filters=filters)
@@ -403,5 +672,49 @@ def get_collection_count(context, model, filters=None, query_field=None):
                         model columns.
     :returns: The number of objects for said model with filters applied.
     """
+    query = _get_count_query(context, model, filters)
+    if query is not None:
+        return query.scalar()
     return get_collection_query(context, model, filters=filters,
                                 field=query_field).count()
+
+
+def _get_count_query(context, model, filters):
+    """Build a query counting a collection without its RBAC union.
+
+    For a project, the collection query of a model with RBAC entries unions
+    the objects shared with the project with the objects it owns, which
+    MySQL materializes as a derived table before counting its rows. This
+    query counts the distinct primary keys of the model instead, matching
+    the RBAC entries with an EXISTS clause. Query hooks and the 'shared'
+    filter work on the unioned queries, so they are left to the collection
+    query, as are the collection queries without a union.
+
+    :param context: The context to use for the DB session.
+    :param model: The model for the query.
+    :param filters: The filters to apply.
+    :returns: The count query, None if the collection query has to be used.
+    """
+    if (not hasattr(model, 'rbac_entries') or
+            (filters and 'shared' in filters) or
+            not db_utils.model_query_scope_is_project(context, model)):
+        return None
+    primary_key = sa.inspect(model).primary_key
+    hooks = _get_resolved_hooks(model)
+    if len(primary_key) != 1 or hooks.query:
+        return None
+
+    scoped = _get_scoped_query(context, model, None, True)
+    query_filter, rbac_query_filter = _run_filter_hooks(
+        context, model, hooks, scoped.query_filter, scoped.rbac_query_filter)
+    owned_or_shared = or_(scoped.model_query_filter,
+                          model.rbac_entries.any(rbac_query_filter))
+    if query_filter is not None:
+        query_filter = and_(owned_or_shared, query_filter)
+    else:
+        query_filter = owned_or_shared
+
+    query = context.session.query(
+        sa.func.count(sa.distinct(primary_key[0]))).select_from(model)
+    query = apply_filters(query.filter(query_filter), model, filters, context)
+    return query.params({_PROJECT_PARAM: context.tenant_id})
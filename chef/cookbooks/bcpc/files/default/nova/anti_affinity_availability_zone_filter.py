@@ -15,16 +15,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-
-from nova import availability_zones
-from nova import context
-from nova.scheduler import filters
+from nova.scheduler import bcpc_utils
 from oslo_log import log as logging
 
 LOG = logging.getLogger(__name__)
 
 
-class _AntiAffinityAvailabilityZoneFilter(filters.BaseHostFilter):
+class _AntiAffinityAvailabilityZoneFilter(bcpc_utils.BaseBCPCFilter):
     """Checks the availability zone of the host if the
 
     availability_zone_anti_affinity is set to true.
@@ -42,28 +39,22 @@ class _AntiAffinityAvailabilityZoneFilter(filters.BaseHostFilter):
         # Only invoke the filter if 'anti-affinity' and scheduler
         # hint anti_affinity_policy = availability_zone is configured
         instance_group = spec_obj.instance_group
-        policy = instance_group.policy if instance_group else None
-        az_hint = spec_obj.get_scheduler_hint('anti_affinity_policy', None)
         # if the policy is not anti-affinity and anti_affinity_policy scheduler
         # hint is not availability_zone then return true and don't apply filter
-        if self.policy_name != policy or az_hint != 'availability_zone':
+        if not bcpc_utils.availability_zone_anti_affinity(
+                spec_obj, (self.policy_name,)):
             return True
         # Move operations like resize can check the same source compute node
         # where the instance is. That case, AntiAffinityAvailabilityZoneFilter
         # must not return the source as a non-possible destination.
         if spec_obj.instance_uuid in host_state.instances.keys():
             return True
-        # list of hosts of non-deleted instances in the server group
-        hosts_group_members = (
-            spec_obj.instance_group.hosts if spec_obj.instance_group else [])
-        # set of availability zones of the instances in the server group
-        instance_group_availability_zones = set()
-        host_availability_zone = availability_zones.get_host_availability_zone(
-            context.get_admin_context(), host_state.host)
-        for host in hosts_group_members:
-            instance_group_availability_zones.add(
-                availability_zones.get_host_availability_zone(
-                    context.get_admin_context(), host))
+        # resolved first, as it rebuilds the map if the host changed zone
+        host_availability_zone = (
+            bcpc_utils.AVAILABILITY_ZONES.host_state_zone(host_state))
+        # availability zones of the instances in the server group
+        instance_group_availability_zones = (
+            bcpc_utils.GROUP_AVAILABILITY_ZONES.get(spec_obj))
         # Very old request specs don't have a full InstanceGroup with the UUID
         group_uuid = (instance_group.uuid
                       if instance_group and 'uuid' in instance_group
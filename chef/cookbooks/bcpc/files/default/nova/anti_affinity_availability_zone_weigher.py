@@ -0,0 +1,64 @@
+# Copyright (c) 2023 Bloomberg
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Anti-affinity Availability Zone Weigher.
+
+The AntiAffinityAvailabilityZoneFilter rejects every host of the availability
+zones the server group already has members in, so a group larger than the
+number of zones fails with NoValidHost. This weigher is its soft companion:
+for the same anti_affinity_policy=availability_zone scheduler hint, hosts are
+weighed by the number of group members already in their zone, and placements
+spread over the least used zones instead of failing.
+
+It applies to both anti-affinity and soft-anti-affinity server groups. Used
+with soft-anti-affinity groups, or without the filter, it lets a group grow
+past the number of zones.
+"""
+
+import nova.conf
+from nova.scheduler import bcpc_utils
+from nova.scheduler import utils
+
+CONF = nova.conf.CONF
+
+POLICIES = ('anti-affinity', 'soft-anti-affinity')
+
+
+class AntiAffinityAvailabilityZoneWeigher(bcpc_utils.BaseBCPCWeigher):
+    maxval = 0
+
+    # The weights change whenever a member of the group is placed
+    incremental = False
+
+    def weight_multiplier(self, host_state):
+        """Override the weight multiplier."""
+        return utils.get_weight_multiplier(
+            host_state, 'az_anti_affinity_weight_multiplier',
+            CONF.bcpc_scheduler.az_anti_affinity_weight_multiplier)
+
+    def _weigh_hosts(self, host_states, weight_properties):
+        """Higher weights win.  Hosts in the less used zones win."""
+        if not bcpc_utils.availability_zone_anti_affinity(
+                weight_properties, POLICIES):
+            return [0] * len(host_states)
+
+        zones = [bcpc_utils.AVAILABILITY_ZONES.host_state_zone(host_state)
+                 for host_state in host_states]
+        counts = bcpc_utils.GROUP_AVAILABILITY_ZONES.get(weight_properties)
+        return [-counts[zone] for zone in zones]
+
+    def _weigh_object(self, host_state, weight_properties):
+        return self._weigh_hosts([host_state], weight_properties)[0]
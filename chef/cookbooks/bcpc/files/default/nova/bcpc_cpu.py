@@ -33,17 +33,16 @@ negative weight. Also to make the spread more even, the CPU idle percentage is
 plugged in the weight.
 """
 
+import array
+
 import nova.conf
+from nova.scheduler import bcpc_utils
 from nova.scheduler import utils
-from nova.scheduler import weights
-from oslo_log import log as logging
 
 CONF = nova.conf.CONF
 
-LOG = logging.getLogger(__name__)
-
 
-class BCPCCPUWeigher(weights.BaseHostWeigher):
+class BCPCCPUWeigher(bcpc_utils.BaseBCPCWeigher):
     minval = 0
 
     def weight_multiplier(self, host_state):
@@ -52,39 +51,117 @@ class BCPCCPUWeigher(weights.BaseHostWeigher):
             host_state, 'cpu_weight_multiplier',
             CONF.filter_scheduler.cpu_weight_multiplier)
 
-    def _get_cpu_idle(self, host_state):
-        """Extract CPU idle percentage from host metrics."""
-        for metric in host_state.metrics.to_list():
-            if metric['name'] == 'cpu.idle.percent':
-                return metric['value']
+    def __init__(self):
+        super(BCPCCPUWeigher, self).__init__()
+        self._idle_samples = bcpc_utils.SampleStore(
+            CONF.bcpc_scheduler.cpu_idle_window,
+            CONF.bcpc_scheduler.cpu_idle_ewma_alpha)
 
-        LOG.warning("Host %s has `cpu.idle.percent` missing.", host_state.host)
-        return 1
+    def _get_cpu_idle(self, host_state):
+        """Extract CPU idle percentage from host metrics.
+
+        Depending on cpu_idle_mode, the last sample is either used as is or
+        smoothed with the samples previously reported by the host.
+        """
+        sample = bcpc_utils.METRICS.get_sample(host_state, 'cpu.idle.percent')
+        if sample is None:
+            return 1
+
+        cpu_idle, timestamp = sample
+        mode = CONF.bcpc_scheduler.cpu_idle_mode
+        if mode == 'raw':
+            return cpu_idle
+
+        self._idle_samples.add(host_state.host, cpu_idle, timestamp)
+        if mode == 'ewma':
+            return self._idle_samples.ewma(host_state.host)
+        return self._idle_samples.percentile(
+            host_state.host, CONF.bcpc_scheduler.cpu_idle_percentile)
 
     def _weigh_object(self, host_state, weight_properties):
         """Higher weights win.  We want spreading to be the default."""
-        vcpus_total = host_state.vcpus_total * host_state.cpu_allocation_ratio
-        # The number of vCPUs that will be used on the host (VM included)
-        used_vcpus = host_state.vcpus_used + weight_properties.flavor.vcpus
-        cpu_idle = self._get_cpu_idle(host_state)
-
-        # Compute the average usage of every current vCPU
-        average_usage = 0
-        if host_state.vcpus_used > 0:
-            average_usage = (1 - cpu_idle) / host_state.vcpus_used
-
-        # Assume the VM will use the average value for each requested vCPU
-        new_idle = 1 - average_usage * used_vcpus
-        # Percentage of vCPUs used after scheduling (future state)
-        free_percentage = 1 - float(used_vcpus) / vcpus_total
-
-        weight = free_percentage
-        if free_percentage > 0:
-            weight = free_percentage * new_idle
-        elif new_idle > 0:
-            # When the CPU is overloaded the free percentage is negative.
-            # To prevent the weight from growing when the idle time is lower,
-            # the reverse if the idle percentage is used.
-            weight = free_percentage * (1 / new_idle)
-
-        return weight
+        return _cpu_weight(
+            host_state.vcpus_total * host_state.cpu_allocation_ratio,
+            host_state.vcpus_used,
+            self._get_cpu_idle(host_state),
+            weight_properties.flavor.vcpus)
+
+    def _weigh_hosts(self, host_states, weight_properties):
+        """Weigh all the hosts of a request in a single pass.
+
+        The host attributes are collected into contiguous arrays and the
+        weights are computed with NumPy when it is available, falling back to
+        the scalar formula otherwise. Both give the same results as
+        _weigh_object.
+        """
+        vcpus_total = array.array('d', [
+            h.vcpus_total * h.cpu_allocation_ratio for h in host_states])
+
+        # Let the scalar path raise on hosts without any vCPU
+        if not all(vcpus_total):
+            return super(BCPCCPUWeigher, self)._weigh_hosts(
+                host_states, weight_properties)
+
+        vcpus_used = array.array('d', [h.vcpus_used for h in host_states])
+        cpu_idle = array.array('d', [
+            self._get_cpu_idle(h) for h in host_states])
+        flavor_vcpus = weight_properties.flavor.vcpus
+
+        if bcpc_utils.np is not None:
+            return _cpu_weights_np(
+                vcpus_total, vcpus_used, cpu_idle, flavor_vcpus)
+        return [_cpu_weight(*host, flavor_vcpus)
+                for host in zip(vcpus_total, vcpus_used, cpu_idle)]
+
+
+def _cpu_weight(vcpus_total, vcpus_used, cpu_idle, flavor_vcpus):
+    # The number of vCPUs that will be used on the host (VM included)
+    used_vcpus = vcpus_used + flavor_vcpus
+
+    # Compute the average usage of every current vCPU
+    average_usage = 0
+    if vcpus_used > 0:
+        average_usage = (1 - cpu_idle) / vcpus_used
+
+    # Assume the VM will use the average value for each requested vCPU
+    new_idle = 1 - average_usage * used_vcpus
+    # Percentage of vCPUs used after scheduling (future state)
+    free_percentage = 1 - float(used_vcpus) / vcpus_total
+
+    weight = free_percentage
+    if free_percentage > 0:
+        weight = free_percentage * new_idle
+    elif new_idle > 0:
+        # When the CPU is overloaded the free percentage is negative.
+        # To prevent the weight from growing when the idle time is lower,
+        # the reverse if the idle percentage is used.
+        weight = free_percentage * (1 / new_idle)
+
+    return weight
+
+
+def _cpu_weights_np(vcpus_total, vcpus_used, cpu_idle, flavor_vcpus):
+    """Vectorized version of _cpu_weight over arrays of hosts."""
+    np = bcpc_utils.np
+    vcpus_total = np.frombuffer(vcpus_total)
+    vcpus_used = np.frombuffer(vcpus_used)
+    cpu_idle = np.frombuffer(cpu_idle)
+
+    used_vcpus = vcpus_used + flavor_vcpus
+
+    average_usage = np.zeros_like(vcpus_used)
+    np.divide(1 - cpu_idle, vcpus_used, out=average_usage,
+              where=vcpus_used > 0)
+
+    new_idle = 1 - average_usage * used_vcpus
+    free_percentage = 1 - used_vcpus / vcpus_total
+
+    inverse_idle = np.ones_like(new_idle)
+    np.divide(1, new_idle, out=inverse_idle, where=new_idle > 0)
+
+    weights = np.where(
+        free_percentage > 0, free_percentage * new_idle,
+        np.where(new_idle > 0, free_percentage * inverse_idle,
+                 free_percentage))
+
+    return weights.tolist()
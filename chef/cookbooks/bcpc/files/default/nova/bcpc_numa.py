@@ -0,0 +1,135 @@
+# Copyright (c) 2023 Bloomberg
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+BCPC NUMA Weigher.  Weigh hosts by the headroom of their best NUMA cell.
+
+The BCPC CPU and RAM weighers look at a hypervisor as one flat pool of vCPUs
+and memory. Guests with a NUMA topology (pinned CPUs or explicit NUMA nodes)
+have to fit in single host NUMA cells though, so a host with plenty of free
+vCPUs spread over its cells may still be rejected by the NUMATopologyFilter.
+
+This weigher scores a host by the free pinned CPUs, shared CPUs and memory
+left, after scheduling, in the cells that best fit the requested guest cells.
+Hosts where no cell can fit the guest get a negative weight. Requests without
+a NUMA topology are not weighed by it.
+"""
+
+import weakref
+
+import nova.conf
+from nova.scheduler import bcpc_utils
+from nova.scheduler import utils
+
+CONF = nova.conf.CONF
+
+
+class BCPCNUMAWeigher(bcpc_utils.BaseBCPCWeigher):
+    minval = -1
+
+    def __init__(self):
+        super(BCPCNUMAWeigher, self).__init__()
+        self._cells = weakref.WeakKeyDictionary()
+
+    def weight_multiplier(self, host_state):
+        """Override the weight multiplier."""
+        return utils.get_weight_multiplier(
+            host_state, 'numa_weight_multiplier',
+            CONF.bcpc_scheduler.numa_weight_multiplier)
+
+    def _get_cells(self, host_state):
+        """Return the per-cell capacity and usage of a host.
+
+        The NUMA topology of a HostState is replaced when the compute node is
+        refreshed or when an instance of the request is consumed from it, so
+        the cells of a host are only walked again once their topology has
+        changed.
+        """
+        topology = host_state.numa_topology
+        cached = self._cells.get(host_state)
+        if cached is not None and cached[0] is topology:
+            return cached[1]
+
+        cells = []
+        for cell in topology.cells if topology else []:
+            cells.append((len(cell.pcpuset), len(cell.free_pcpus),
+                          len(cell.cpuset), cell.cpu_usage,
+                          cell.memory, cell.memory_usage))
+
+        self._cells[host_state] = (topology, cells)
+        return cells
+
+    def _incremental(self, weight_properties):
+        """Only reuse the weights of requests with a NUMA topology.
+
+        The others weigh every host 0, cheaper than looking up the cached
+        weights.
+        """
+        instance_topology = weight_properties.numa_topology
+        return bool(instance_topology and instance_topology.cells)
+
+    def _weigh_object(self, host_state, weight_properties):
+        """Higher weights win.  We want spreading to be the default."""
+        instance_topology = weight_properties.numa_topology
+        if not instance_topology or not instance_topology.cells:
+            return 0
+
+        # Weigh every host cell against the largest requested guest cell
+        pinned = max(len(c.pcpuset) for c in instance_topology.cells)
+        shared = max(len(c.cpuset) for c in instance_topology.cells)
+        memory = max(c.memory for c in instance_topology.cells)
+
+        scores = []
+        for cell in self._get_cells(host_state):
+            scores.append(_cell_score(
+                cell, pinned, shared, memory,
+                host_state.cpu_allocation_ratio,
+                host_state.ram_allocation_ratio))
+
+        # Every guest cell needs its own host cell
+        wanted = len(instance_topology.cells)
+        if len(scores) < wanted:
+            return self.minval
+
+        scores.sort(reverse=True)
+        return max(scores[wanted - 1], self.minval)
+
+
+def _cell_score(cell, pinned, shared, memory, cpu_ratio, ram_ratio):
+    """Return the fraction of a host cell still free after scheduling.
+
+    The most constrained of the pinned CPUs, shared CPUs and memory wins, so
+    the result is negative when the guest cell does not fit.
+    """
+    (pcpus_total, pcpus_free, cpus_total, cpus_used,
+     memory_total, memory_used) = cell
+
+    fractions = []
+    if pinned:
+        if not pcpus_total:
+            return -1
+        fractions.append(float(pcpus_free - pinned) / pcpus_total)
+    if shared:
+        cpus_limit = cpus_total * cpu_ratio
+        if not cpus_limit:
+            return -1
+        fractions.append((cpus_limit - cpus_used - shared) / cpus_limit)
+
+    memory_limit = memory_total * ram_ratio
+    if not memory_limit:
+        return -1
+    fractions.append((memory_limit - memory_used - memory) / memory_limit)
+
+    return min(fractions)
@@ -25,16 +25,29 @@ For heterogeneous clusters geared around performance, this behavior is likely
 suboptimal. This modified weigher spreads allocations unconditionally by
 normalizing the weight to the range [0,1] according to the capabilities of this
 specific hypervisor. The amount of memory used by the guest is also weighed in.
+
+In the pressure mode, hosts are also penalized in proportion to the time their
+CPUs spend waiting on I/O, reported as cpu.iowait.percent by the
+cpu.virt_driver compute monitor. A hypervisor swapping guest memory out shows
+up as I/O wait, so guests stop landing on hypervisors about to thrash. Nova
+only accepts the metric names of its MonitorMetricType enum, which has no
+memory usage, swap or KSM metric.
 """
 
+import array
+
 import nova.conf
+from nova.scheduler import bcpc_utils
 from nova.scheduler import utils
-from nova.scheduler import weights
 
 CONF = nova.conf.CONF
 
+# metric weighed in the pressure mode, a fraction in [0, 1] once read
+# through the metrics index
+CPU_IOWAIT_PERCENT = 'cpu.iowait.percent'
 
-class BCPCRAMWeigher(weights.BaseHostWeigher):
+
+class BCPCRAMWeigher(bcpc_utils.BaseBCPCWeigher):
     minval = 0
 
     def weight_multiplier(self, host_state):
@@ -46,4 +59,51 @@ class BCPCRAMWeigher(weights.BaseHostWeigher):
     def _weigh_object(self, host_state, weight_properties):
         """Higher weights win.  We want spreading to be the default."""
         free_ram = host_state.free_ram_mb - weight_properties.flavor.memory_mb
-        return free_ram / float(host_state.total_usable_ram_mb)
+        weight = free_ram / float(host_state.total_usable_ram_mb)
+
+        if CONF.bcpc_scheduler.ram_weigher_mode == 'pressure':
+            weight = self._weigh_pressure(
+                host_state, weight_properties, weight)
+        return weight
+
+    def _weigh_pressure(self, host_state, weight_properties, weight):
+        """Weigh in the I/O wait reported by the host metrics."""
+        iowait = bcpc_utils.METRICS.get(host_state, CPU_IOWAIT_PERCENT, 0)
+        iowait_limit = CONF.bcpc_scheduler.ram_iowait_limit
+        return weight - min(iowait / iowait_limit, 1.0)
+
+    def _incremental(self, weight_properties):
+        """Only reuse the weights of the pressure mode.
+
+        The other modes are weighed in one vectorized pass, cheaper than
+        looking up the cached weights.
+        """
+        return CONF.bcpc_scheduler.ram_weigher_mode == 'pressure'
+
+    def _weigh_hosts(self, host_states, weight_properties):
+        """Weigh all the hosts of a request in a single pass.
+
+        Gives the same results as _weigh_object, using NumPy when it is
+        available and a pure-Python loop over arrays otherwise.
+        """
+        if CONF.bcpc_scheduler.ram_weigher_mode == 'pressure':
+            return super(BCPCRAMWeigher, self)._weigh_hosts(
+                host_states, weight_properties)
+
+        total_ram = array.array('d', [
+            h.total_usable_ram_mb for h in host_states])
+
+        # Let the scalar path raise on hosts without any usable RAM
+        if not all(total_ram):
+            return super(BCPCRAMWeigher, self)._weigh_hosts(
+                host_states, weight_properties)
+
+        free_ram = array.array('d', [h.free_ram_mb for h in host_states])
+        memory_mb = weight_properties.flavor.memory_mb
+
+        np = bcpc_utils.np
+        if np is not None:
+            return ((np.frombuffer(free_ram) - memory_mb) /
+                    np.frombuffer(total_ram)).tolist()
+        return [(free - memory_mb) / total
+                for free, total in zip(free_ram, total_ram)]
@@ -0,0 +1,105 @@
+# Copyright (c) 2023 Bloomberg
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+BCPC Resource Weigher.  Weigh hosts by their dominant resource share.
+
+Running the CPU, RAM and disk weighers side by side normalizes each resource
+independently and relies on hand-tuned multipliers to balance them. This
+weigher replaces the three of them with a single pass over the hosts.
+
+For every host, the share of vCPUs, RAM and disk used after scheduling the
+guest is computed and the largest of them, the dominant share, decides the
+weight. Hosts are therefore filled evenly on the resource they are the
+shortest of, which keeps heterogeneous hypervisors balanced.
+"""
+
+import array
+
+import nova.conf
+from nova.scheduler import bcpc_utils
+from nova.scheduler import utils
+
+CONF = nova.conf.CONF
+
+
+class BCPCResourceWeigher(bcpc_utils.BaseBCPCWeigher):
+    minval = 0
+
+    def weight_multiplier(self, host_state):
+        """Override the weight multiplier."""
+        return utils.get_weight_multiplier(
+            host_state, 'resource_weight_multiplier',
+            CONF.bcpc_scheduler.resource_weight_multiplier)
+
+    def _weigh_object(self, host_state, weight_properties):
+        """Higher weights win.  We want spreading to be the default."""
+        return 1 - max(
+            _share(total, used)
+            for total, used in _resources(host_state, weight_properties))
+
+    def _weigh_hosts(self, host_states, weight_properties):
+        """Weigh all the hosts of a request in a single pass."""
+        totals = [array.array('d') for i in range(3)]
+        used = [array.array('d') for i in range(3)]
+        for host_state in host_states:
+            resources = _resources(host_state, weight_properties)
+            for i, (total, used_after) in enumerate(resources):
+                totals[i].append(total)
+                used[i].append(used_after)
+
+        np = bcpc_utils.np
+        if np is not None:
+            shares = []
+            for total, used_after in zip(totals, used):
+                total = np.frombuffer(total)
+                share = np.zeros_like(total)
+                np.divide(np.frombuffer(used_after), total, out=share,
+                          where=total > 0)
+                shares.append(share)
+            return (1 - np.maximum.reduce(shares)).tolist()
+        return [
+            1 - max(_share(t, u) for t, u in zip(host_totals, host_used))
+            for host_totals, host_used in zip(zip(*totals), zip(*used))]
+
+
+def _resources(host_state, weight_properties):
+    """Return the (total, used after scheduling) vCPUs, RAM and disk."""
+    flavor = weight_properties.flavor
+
+    vcpus_total = host_state.vcpus_total * host_state.cpu_allocation_ratio
+    vcpus_used = host_state.vcpus_used + flavor.vcpus
+
+    ram_total = host_state.total_usable_ram_mb
+    ram_used = ram_total - host_state.free_ram_mb + flavor.memory_mb
+
+    # The root disk of a volume-backed instance is not on the host
+    disk_gb = flavor.ephemeral_gb
+    if not ('is_bfv' in weight_properties and weight_properties.is_bfv):
+        disk_gb += flavor.root_gb
+    disk_total = host_state.total_usable_disk_gb * 1024
+    disk_used = (disk_total - host_state.free_disk_mb + disk_gb * 1024 +
+                 flavor.swap)
+
+    return ((vcpus_total, vcpus_used),
+            (ram_total, ram_used),
+            (disk_total, disk_used))
+
+
+def _share(total, used):
+    """Return the share of a resource used, ignoring unreported ones."""
+    if total <= 0:
+        return 0
+    return float(used) / total
@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2023 Bloomberg
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+BCPC scheduler simulator.  Replay boot requests against the BCPC scheduler
+filters and weighers installed on a nova-scheduler node.
+
+The simulator builds a cell of fake hosts, replays a trace of boot requests
+through the filters and weighers the same way the filter scheduler does and
+consumes every placed instance from its host. It reports the latency and
+throughput of each plugin along with the spread of the resulting placements,
+so that plugins and weigher modes can be compared before a rollout.
+
+A trace is a file with one JSON boot request per line, e.g.:
+
+    {"flavor": {"vcpus": 4, "memory_mb": 8192, "root_gb": 20},
+     "num_instances": 2,
+     "image_properties": {"traits_required": ["CUSTOM_LICENSE"]},
+     "group": "web", "group_policy": "anti-affinity",
+     "scheduler_hints": {"anti_affinity_policy": "availability_zone"}}
+
+Without a trace, a synthetic one is generated.
+"""
+
+import argparse
+import collections
+import datetime
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+import uuid
+
+import nova.conf
+from nova import exception
+from nova import objects
+from nova.scheduler import bcpc_utils
+from nova.scheduler import weights
+from oslo_utils import importutils
+
+CONF = nova.conf.CONF
+
+DEFAULT_FILTERS = [
+    'nova.scheduler.filters.anti_affinity_availability_zone_filter.'
+    'AntiAffinityAvailabilityZoneFilter',
+]
+
+LICENSE_FILTER = (
+    'nova.scheduler.filters.required_image_property_filter.'
+    'RequiredImagePropertyFilter')
+
+DEFAULT_WEIGHERS = [
+    'nova.scheduler.weights.bcpc_cpu.BCPCCPUWeigher',
+    'nova.scheduler.weights.bcpc_ram.BCPCRAMWeigher',
+    'nova.scheduler.weights.anti_affinity_availability_zone_weigher.'
+    'AntiAffinityAvailabilityZoneWeigher',
+]
+
+FLAVORS = [
+    {'vcpus': 1, 'memory_mb': 2048, 'root_gb': 20},
+    {'vcpus': 2, 'memory_mb': 4096, 'root_gb': 20},
+    {'vcpus': 4, 'memory_mb': 8192, 'root_gb': 40},
+    {'vcpus': 8, 'memory_mb': 16384, 'root_gb': 80},
+    {'vcpus': 16, 'memory_mb': 65536, 'root_gb': 160},
+]
+
+
+class FakeHostState(object):
+    """The HostState attributes read by the BCPC plugins."""
+
+    def __init__(self, host, vcpus, ram_mb, disk_gb, cpu_idle):
+        self.host = host
+        self.nodename = host
+        self.vcpus_total = vcpus
+        self.vcpus_used = 0
+        self.cpu_allocation_ratio = 4.0
+        self.ram_allocation_ratio = 1.0
+        self.disk_allocation_ratio = 1.0
+        self.total_usable_ram_mb = ram_mb
+        self.free_ram_mb = ram_mb
+        self.total_usable_disk_gb = disk_gb
+        self.free_disk_mb = disk_gb * 1024
+        self.num_instances = 0
+        self.instances = {}
+        self.aggregates = []
+        self.numa_topology = None
+        self.cpu_idle = cpu_idle
+        self.updated = None
+        self.metrics = None
+        self._refresh_metrics()
+
+    def _refresh_metrics(self):
+        self.updated = datetime.datetime.utcnow()
+        # Assume the host starts swapping once 90% of its RAM is used
+        ram_used = 1 - float(self.free_ram_mb) / self.total_usable_ram_mb
+        cpu_iowait = min(max(ram_used - 0.9, 0.0) * 5, 1.0)
+        self.metrics = objects.MonitorMetricList(objects=[
+            objects.MonitorMetric(
+                name=name, value=int(value * 100), timestamp=self.updated,
+                source='bcpc-scheduler-simulator')
+            for name, value in (('cpu.idle.percent', self.cpu_idle),
+                                ('cpu.iowait.percent', cpu_iowait))])
+
+    def consume(self, spec, instance_uuid):
+        flavor = spec.flavor
+        self.vcpus_used += flavor.vcpus
+        self.free_ram_mb -= flavor.memory_mb
+        self.free_disk_mb -= (
+            (flavor.root_gb + flavor.ephemeral_gb) * 1024 + flavor.swap)
+        self.num_instances += 1
+        self.instances[instance_uuid] = None
+
+        # Assume the new guest keeps the average vCPU as busy as the others
+        self.cpu_idle = max(0.0, self.cpu_idle - (
+            float(flavor.vcpus) / (self.vcpus_total * 2)))
+        self._refresh_metrics()
+
+    def __repr__(self):
+        return '(%s)' % self.host
+
+
+class CellAvailabilityZoneMap(bcpc_utils.AvailabilityZoneMap):
+    """The availability zone map, built from the aggregates of the cell."""
+
+    def __init__(self, aggregates):
+        super(CellAvailabilityZoneMap, self).__init__()
+        self._cell_aggregates = aggregates
+
+    def _get_aggregates(self):
+        return self._cell_aggregates
+
+
+class FakeInstanceGroup(object):
+    def __init__(self, name, policy):
+        self.name = name
+        self.uuid = str(uuid.uuid4())
+        self.policy = policy
+        self.hosts = []
+
+    def __contains__(self, name):
+        return hasattr(self, name)
+
+
+class FakeFlavor(object):
+    def __init__(self, vcpus, memory_mb, root_gb=0, ephemeral_gb=0, swap=0,
+                 extra_specs=None):
+        self.vcpus = vcpus
+        self.memory_mb = memory_mb
+        self.root_gb = root_gb
+        self.ephemeral_gb = ephemeral_gb
+        self.swap = swap
+        self.extra_specs = extra_specs or {}
+
+
+class FakeImage(object):
+    def __init__(self, properties):
+        self.properties = properties
+
+
+class FakeRequestSpec(object):
+    """The RequestSpec attributes read by the BCPC plugins."""
+
+    def __init__(self, flavor, num_instances=1, image_properties=None,
+                 instance_group=None, scheduler_hints=None):
+        self.flavor = flavor
+        self.num_instances = num_instances
+        self.image = FakeImage(image_properties or {})
+        self.instance_group = instance_group
+        self.scheduler_hints = scheduler_hints or {}
+        self.instance_uuid = None
+        self.numa_topology = None
+        self.is_bfv = False
+        self.root_required = set()
+
+    def get_scheduler_hint(self, hint, default=None):
+        return self.scheduler_hints.get(hint, default)
+
+    def __contains__(self, name):
+        return hasattr(self, name)
+
+
+def make_hosts(count, azs, seed):
+    """Build a heterogeneous cell of count hosts spread over azs zones."""
+    rand = random.Random(seed)
+    hosts = []
+    az_map = {}
+    for i in range(count):
+        host = FakeHostState(
+            'cmpt%05d' % i,
+            vcpus=rand.choice([32, 48, 64, 96, 128]),
+            ram_mb=rand.choice([256, 384, 512, 768, 1024]) * 1024,
+            disk_gb=rand.choice([1024, 2048, 4096]),
+            cpu_idle=rand.uniform(0.5, 1.0))
+        hosts.append(host)
+        az_map[host.host] = 'az%d' % (i % azs)
+    return hosts, az_map
+
+
+def load_trace(path):
+    """Load recorded boot requests, one JSON object per line."""
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def make_trace(count, image_traits, group_policy, seed, num_instances=None):
+    """Generate count boot requests.
+
+    One request in five belongs to a server group with AZ anti-affinity.
+    Requests boot num_instances instances, a mix of 1 to 4 if not given.
+    """
+    rand = random.Random(seed)
+    trace = []
+    for i in range(count):
+        request = {
+            'flavor': rand.choice(FLAVORS),
+            'num_instances': num_instances or rand.choice([1, 1, 1, 2, 4]),
+        }
+        if image_traits:
+            request['image_properties'] = {
+                'traits_required': [rand.choice(image_traits)]}
+        if rand.random() < 0.2:
+            request['group'] = 'group%d' % rand.randrange(count // 10 + 1)
+            request['group_policy'] = group_policy
+            request['scheduler_hints'] = {
+                'anti_affinity_policy': 'availability_zone'}
+        trace.append(request)
+    return trace
+
+
+class Simulator(object):
+
+    def __init__(self, filter_classes, weigher_classes, host_aggregates):
+        self.host_aggregates = host_aggregates
+        self.filters = [importutils.import_class(c)() for c in filter_classes]
+        self.weighers = [importutils.import_class(c)()
+                         for c in weigher_classes]
+        self.weight_handler = weights.HostWeightHandler()
+        self.timings = collections.defaultdict(list)
+        self.hosts_seen = collections.Counter()
+        self.groups = {}
+        self.placed = 0
+        self.failed = 0
+
+        # Time the weighers as they are called by the weight handler
+        for weigher in self.weighers:
+            weigher.weigh_objects = self._timed_weigher(weigher)
+
+    def _record(self, name, hosts, start):
+        self.timings[name].append(time.perf_counter() - start)
+        self.hosts_seen[name] += hosts
+
+    def _timed_weigher(self, weigher):
+        name = type(weigher).__name__
+        weigh_objects = weigher.weigh_objects
+
+        def timed_weigh_objects(weighed_obj_list, weight_properties):
+            start = time.perf_counter()
+            try:
+                return weigh_objects(weighed_obj_list, weight_properties)
+            finally:
+                self._record(name, len(weighed_obj_list), start)
+
+        return timed_weigh_objects
+
+    def _filter(self, hosts, spec, index):
+        for host_filter in self.filters:
+            if not host_filter.run_filter_for_index(index):
+                continue
+            start = time.perf_counter()
+            passed = list(host_filter.filter_all(hosts, spec))
+            self._record(type(host_filter).__name__, len(hosts), start)
+            hosts = passed
+            if not hosts:
+                break
+        return hosts
+
+    def _prefilter(self, hosts, spec):
+        """Drop the hosts placement would not return for the request."""
+        for prefilter in (bcpc_utils.az_anti_affinity_prefilter,
+                          bcpc_utils.license_traits_prefilter):
+            start = time.perf_counter()
+            try:
+                prefilter(None, spec)
+            except exception.RequestFilterFailed:
+                return []
+            finally:
+                self._record(prefilter.__name__, len(hosts), start)
+
+        if 'requested_destination' not in spec:
+            return hosts
+        forbidden = spec.requested_destination.forbidden_aggregates or set()
+        return [host for host in hosts
+                if self.host_aggregates.get(host.host) not in forbidden]
+
+    def _weigh(self, hosts, spec):
+        return self.weight_handler.get_weighed_objects(
+            self.weighers, hosts, spec)
+
+    def _make_spec(self, request):
+        group = None
+        if request.get('group'):
+            group = self.groups.setdefault(request['group'], FakeInstanceGroup(
+                request['group'], request.get('group_policy')))
+
+        return FakeRequestSpec(
+            FakeFlavor(**request['flavor']),
+            num_instances=request.get('num_instances', 1),
+            image_properties=request.get('image_properties'),
+            instance_group=group,
+            scheduler_hints=request.get('scheduler_hints'))
+
+    def schedule(self, hosts, request):
+        spec = self._make_spec(request)
+        hosts = self._prefilter(hosts, spec)
+        for index in range(spec.num_instances):
+            spec.instance_uuid = str(uuid.uuid4())
+            candidates = self._filter(hosts, spec, index)
+            if not candidates:
+                self.failed += spec.num_instances - index
+                return
+
+            chosen = self._weigh(candidates, spec)[0].obj
+            chosen.consume(spec, spec.instance_uuid)
+            if spec.instance_group is not None:
+                spec.instance_group.hosts.append(chosen.host)
+            self.placed += 1
+
+
+def _percentile(samples, percentile):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * percentile))]
+
+
+def report(size, simulator, hosts, elapsed):
+    print("== %d hosts: %d instances placed, %d failed in %.2fs" % (
+        size, simulator.placed, simulator.failed, elapsed))
+
+    print("%-40s %8s %10s %10s %14s" % (
+        'plugin', 'calls', 'mean ms', 'p99 ms', 'hosts/s'))
+    for name, samples in sorted(simulator.timings.items()):
+        total = sum(samples)
+        print("%-40s %8d %10.3f %10.3f %14.0f" % (
+            name, len(samples), total / len(samples) * 1000,
+            _percentile(samples, 0.99) * 1000,
+            simulator.hosts_seen[name] / total if total else 0))
+
+    cpu = [float(h.vcpus_used) / (h.vcpus_total * h.cpu_allocation_ratio)
+           for h in hosts]
+    ram = [1 - float(h.free_ram_mb) / h.total_usable_ram_mb for h in hosts]
+    for name, usage in (('vCPU', cpu), ('RAM', ram)):
+        print("%s utilization: mean %.4f variance %.6f max %.4f" % (
+            name, statistics.mean(usage), statistics.pvariance(usage),
+            max(usage)))
+    print()
+
+
+def main():
+    desc = "BCPC scheduler filters and weighers simulator"
+    parser = argparse.ArgumentParser(description=desc)
+
+    parser.add_argument(
+        "--hosts", type=int, nargs="+", default=[100, 1000, 10000],
+        help="cell sizes to simulate")
+    parser.add_argument(
+        "--azs", type=int, default=3,
+        help="number of availability zones the hosts are spread over")
+    parser.add_argument(
+        "--trace", metavar="FILE",
+        help="recorded boot requests, one JSON object per line")
+    parser.add_argument(
+        "--requests", type=int, default=200,
+        help="number of synthetic boot requests without a trace")
+    parser.add_argument(
+        "--num-instances", type=int,
+        help="instances booted by every synthetic request, e.g. to compare "
+             "bcpc_scheduler.incremental_weighing on large batches")
+    parser.add_argument(
+        "--image-trait", dest="image_traits", action="append", default=[],
+        help="license trait required by synthetic images, enables the "
+             "required image property filter")
+    parser.add_argument(
+        "--group-policy", default="anti-affinity",
+        choices=("anti-affinity", "soft-anti-affinity"),
+        help="policy of the synthetic server groups")
+    parser.add_argument(
+        "--filter", dest="filters", action="append",
+        help="filter class to run, may be repeated")
+    parser.add_argument(
+        "--weigher", dest="weighers", action="append",
+        help="weigher class to run, may be repeated")
+    parser.add_argument(
+        "--set", dest="overrides", action="append", default=[],
+        metavar="GROUP.OPTION=VALUE",
+        help="override a nova option, e.g. bcpc_scheduler.cpu_idle_mode=ewma")
+    parser.add_argument(
+        "--config-file", dest="config_files", action="append", default=[],
+        help="nova configuration file to load")
+    parser.add_argument(
+        "--seed", type=int, default=0,
+        help="seed of the synthetic cell and trace")
+
+    args = parser.parse_args()
+
+    objects.register_all()
+    CONF([], project='nova', default_config_files=args.config_files)
+    for override in args.overrides:
+        option, value = override.split('=', 1)
+        group, name = option.rsplit('.', 1)
+        CONF.set_override(name, value, group)
+
+    filters = args.filters
+    if filters is None:
+        filters = list(DEFAULT_FILTERS)
+        if args.image_traits:
+            filters.append(LICENSE_FILTER)
+
+    license_traits = None
+    if args.image_traits:
+        # the license traits matched by the required image property filter
+        with tempfile.NamedTemporaryFile(
+                'w', prefix='license-traits', delete=False) as license_traits:
+            license_traits.write('\n'.join(args.image_traits) + '\n')
+        CONF.set_override('license_traits_file', license_traits.name,
+                          'bcpc_scheduler')
+
+    if args.trace:
+        trace = load_trace(args.trace)
+    else:
+        trace = make_trace(args.requests, args.image_traits,
+                           args.group_policy, args.seed, args.num_instances)
+
+    for size in args.hosts:
+        hosts, az_map = make_hosts(size, args.azs, args.seed)
+
+        # The AZ aggregates the BCPC filters resolve hosts with
+        aggregates = [
+            objects.Aggregate(
+                uuid=str(uuid.uuid4()),
+                hosts=[host for host, host_az in az_map.items()
+                       if host_az == az],
+                metadata={'availability_zone': az})
+            for az in set(az_map.values())]
+        host_aggregates = {host: aggregate.uuid for aggregate in aggregates
+                           for host in aggregate.hosts}
+        aggregates_by_uuid = {aggregate.uuid: aggregate
+                              for aggregate in aggregates}
+        for host in hosts:
+            host.aggregates = [aggregates_by_uuid[host_aggregates[host.host]]]
+        simulator = Simulator(filters, args.weighers or DEFAULT_WEIGHERS,
+                              host_aggregates)
+        bcpc_utils.AVAILABILITY_ZONES = CellAvailabilityZoneMap(aggregates)
+
+        start = time.perf_counter()
+        for request in trace:
+            simulator.schedule(hosts, request)
+        elapsed = time.perf_counter() - start
+
+        report(size, simulator, hosts, elapsed)
+
+    if bcpc_utils.INSTRUMENTATION.enabled:
+        bcpc_utils.INSTRUMENTATION.dump()
+    if license_traits is not None:
+        os.unlink(license_traits.name)
+
+
+if __name__ == '__main__':
+    main()
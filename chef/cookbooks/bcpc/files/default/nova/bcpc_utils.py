@@ -0,0 +1,907 @@
+# Copyright (c) 2023 Bloomberg
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Helpers shared by the BCPC scheduler filters and weighers.
+
+NumPy is used to weigh all hosts of a request in a single pass when it is
+available on the scheduler. It is not a hard dependency of nova, so every
+vectorized code path has a pure-Python fallback built on the array module.
+"""
+
+import array
+import bisect
+import collections
+import datetime
+import heapq
+import json
+import os
+import signal
+import time
+import weakref
+
+import nova.conf
+from nova import context
+from nova import exception
+from nova import objects
+from nova.scheduler import filters
+from nova.scheduler import request_filter
+from nova.scheduler import weights
+from nova import weights as base_weights
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_utils import timeutils
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+CONF = nova.conf.CONF
+
+LOG = logging.getLogger(__name__)
+
+bcpc_scheduler_opts = [
+    cfg.StrOpt('cpu_idle_mode',
+               default='raw',
+               choices=('raw', 'ewma', 'percentile'),
+               help="""
+CPU idle signal used by the BCPC CPU weigher.
+
+* raw: the last cpu.idle.percent sample reported by the host
+* ewma: the exponentially weighted moving average of the samples
+* percentile: the cpu_idle_percentile of the last cpu_idle_window samples
+"""),
+    cfg.FloatOpt('cpu_idle_ewma_alpha',
+                 default=0.3,
+                 min=0.0,
+                 max=1.0,
+                 help="Weight of the newest sample in the CPU idle EWMA."),
+    cfg.IntOpt('cpu_idle_window',
+               default=12,
+               min=1,
+               help="Number of CPU idle samples kept per host."),
+    cfg.IntOpt('cpu_idle_percentile',
+               default=50,
+               min=0,
+               max=100,
+               help="Percentile of the CPU idle window used by the weigher."),
+    cfg.StrOpt('ram_weigher_mode',
+               default='allocation',
+               choices=('allocation', 'pressure'),
+               help="""
+Signal used by the BCPC RAM weigher.
+
+* allocation: the RAM left unallocated after scheduling
+* pressure: the allocation, lowered according to the cpu.iowait.percent
+  metric of the host, which a host swapping guest memory out reports
+"""),
+    cfg.FloatOpt('ram_iowait_limit',
+                 default=0.2,
+                 min=0.01,
+                 max=1.0,
+                 help="""
+Fraction of CPU time waiting on I/O, in [0, 1], at which a host gets the
+largest penalty in the pressure mode of the BCPC RAM weigher.
+"""),
+    cfg.FloatOpt('numa_weight_multiplier',
+                 default=1.0,
+                 help="Multiplier used for weighing hosts by NUMA headroom."),
+    cfg.FloatOpt('resource_weight_multiplier',
+                 default=1.0,
+                 help="""
+Multiplier used for weighing hosts by their dominant resource share.
+"""),
+    cfg.StrOpt('license_traits_file',
+               default='/etc/nova/license-traits',
+               help="""
+File listing the license traits matched by the RequiredImagePropertyFilter,
+one per line. It is read again whenever it is modified.
+"""),
+    cfg.BoolOpt('license_traits_prefilter',
+                default=False,
+                help="""
+Check the license traits of the image of a request before querying placement,
+the way the RequiredImagePropertyFilter does, and require the matched trait on
+the compute node. Requests for images without exactly one license trait fail
+without querying placement.
+"""),
+    cfg.BoolOpt('az_anti_affinity_prefilter',
+                default=False,
+                help="""
+Exclude the aggregates of the availability zones a server group already has
+members in from the placement query of requests with the
+anti_affinity_policy=availability_zone scheduler hint, so that placement does
+not return hosts the AntiAffinityAvailabilityZoneFilter would reject.
+"""),
+    cfg.FloatOpt('az_anti_affinity_weight_multiplier',
+                 default=1.0,
+                 min=0.0,
+                 help="""
+Multiplier used for weighing hosts by the number of members of the server
+group of a request in their availability zone, for requests with the
+anti_affinity_policy=availability_zone scheduler hint.
+"""),
+    cfg.BoolOpt('incremental_weighing',
+                default=False,
+                help="""
+Reuse the weights computed for the previous instance of a multi-instance
+request and only weigh again the hosts whose state changed since, i.e. the
+host the previous instance was consumed from. Weighers whose vectorized full
+pass is cheaper than looking up the cached weights always weigh every host.
+"""),
+    cfg.IntOpt('availability_zone_map_ttl',
+               default=300,
+               min=0,
+               help="""
+Seconds after which the host to availability zone map of the BCPC filters is
+built again from the aggregates. The map is also rebuilt when it disagrees with
+the aggregates of a candidate host, which the scheduler keeps up to date.
+"""),
+    cfg.BoolOpt('instrumentation',
+                default=False,
+                help="""
+Time the BCPC filters and weighers and keep a trace of their recent decisions.
+The trace is written to instrumentation_dump_path on SIGUSR1.
+"""),
+    cfg.IntOpt('instrumentation_top_hosts',
+               default=5,
+               min=0,
+               help="Number of best weighed hosts recorded per decision."),
+    cfg.IntOpt('instrumentation_decisions',
+               default=200,
+               min=1,
+               help="Number of recent decisions kept in memory."),
+    cfg.StrOpt('instrumentation_dump_path',
+               help="""
+File the instrumentation is written to. Defaults to
+$state_path/bcpc_scheduler_trace.json. Every nova-scheduler worker inherits
+the SIGUSR1 handler from the parent process and writes its own trace, with
+the pid of the worker added to the file name, e.g.
+bcpc_scheduler_trace.1234.json. Signal the worker processes, the children of
+the nova-scheduler parent, which does not schedule and writes nothing.
+"""),
+]
+
+CONF.register_opts(bcpc_scheduler_opts, group='bcpc_scheduler')
+
+
+def update_weight_bounds(weigher, weights):
+    """Record the min/max weights the way BaseWeigher.weigh_objects does.
+
+    The weight handler normalizes weights with the minval/maxval of the
+    weigher, so a weigher overriding weigh_objects has to keep them updated.
+    """
+    if not weights:
+        return
+
+    if weigher.minval is None:
+        weigher.minval = weights[0]
+    if weigher.maxval is None:
+        weigher.maxval = weights[0]
+
+    weigher.minval = min(weigher.minval, min(weights))
+    weigher.maxval = max(weigher.maxval, max(weights))
+
+
+class WeightCache(object):
+    """Weights of the hosts of the request being scheduled.
+
+    Nova weighs every host again for each instance of a multi-instance
+    request, although only the host the previous instance was consumed from
+    has changed. HostState.updated is bumped whenever a host is refreshed or
+    consumed from, so it tells which cached weights are stale. The weights
+    are kept by (host, nodename) and dropped when a new request comes.
+
+    Nova needs a weight for every host, in order, and sorts the weighed hosts
+    itself, so the cached weights are not kept ordered by weight.
+    """
+
+    def __init__(self):
+        self._request = None
+        self._weights = {}
+
+    def weigh(self, host_states, weight_properties, weigh_hosts):
+        """Return the weights of host_states, computing only stale ones."""
+        request = self._request() if self._request is not None else None
+        if request is not weight_properties:
+            self._request = weakref.ref(weight_properties)
+            self._weights = {}
+
+        cache = self._weights
+        weights = []
+        stale = []
+        for i, host_state in enumerate(host_states):
+            updated = host_state.updated
+            cached = cache.get((host_state.host, host_state.nodename))
+            if cached is None or updated is None or cached[0] != updated:
+                stale.append(i)
+                weights.append(None)
+            else:
+                weights.append(cached[1])
+
+        if stale:
+            stale_hosts = [host_states[i] for i in stale]
+            for i, host_state, weight in zip(
+                    stale, stale_hosts,
+                    weigh_hosts(stale_hosts, weight_properties)):
+                cache[host_state.host, host_state.nodename] = (
+                    host_state.updated, weight)
+                weights[i] = weight
+        return weights
+
+
+class BaseBCPCWeigher(weights.BaseHostWeigher):
+    """Base class of the BCPC weighers.
+
+    Subclasses weigh a list of hosts at once in _weigh_hosts, which lets them
+    vectorize the computation and reuse the weights of unchanged hosts
+    across the instances of a request when incremental_weighing is set.
+    """
+
+    # Weights depending on more than the state of the host, e.g. on the
+    # members of a server group, can't be reused across instances, and
+    # weighers whose full pass is cheaper than the cache lookups opt out
+    incremental = True
+
+    def __init__(self):
+        super(BaseBCPCWeigher, self).__init__()
+        self._weight_cache = WeightCache()
+        INSTRUMENTATION.setup()
+
+    def _weigh_hosts(self, host_states, weight_properties):
+        """Return the weights of host_states, in order."""
+        return [self._weigh_object(host_state, weight_properties)
+                for host_state in host_states]
+
+    def _incremental(self, weight_properties):
+        """Whether the weights of a request are reused across instances."""
+        return self.incremental
+
+    def weigh_objects(self, weighed_obj_list, weight_properties):
+        """Weigh all the hosts of a request in a single pass."""
+        host_states = [obj.obj for obj in weighed_obj_list]
+        if not host_states:
+            return []
+
+        instrumented = INSTRUMENTATION.enabled
+        if instrumented:
+            start = time.monotonic()
+
+        if (CONF.bcpc_scheduler.incremental_weighing and
+                self._incremental(weight_properties)):
+            weights = self._weight_cache.weigh(
+                host_states, weight_properties, self._weigh_hosts)
+        else:
+            weights = self._weigh_hosts(host_states, weight_properties)
+
+        update_weight_bounds(self, weights)
+
+        if instrumented:
+            INSTRUMENTATION.record_weigher(
+                self, weight_properties, host_states, weights, start)
+        return weights
+
+
+class BaseBCPCFilter(filters.BaseHostFilter):
+    """Base class of the BCPC filters, timing them when instrumented."""
+
+    def __init__(self):
+        super(BaseBCPCFilter, self).__init__()
+        INSTRUMENTATION.setup()
+
+    def filter_all(self, filter_obj_list, spec_obj):
+        """Yield the hosts passing the filter."""
+        if not INSTRUMENTATION.enabled:
+            return super(BaseBCPCFilter, self).filter_all(
+                filter_obj_list, spec_obj)
+
+        start = time.monotonic()
+        host_states = list(filter_obj_list)
+        passed = list(super(BaseBCPCFilter, self).filter_all(
+            host_states, spec_obj))
+        INSTRUMENTATION.record_filter(
+            self, spec_obj, len(host_states), len(passed), start)
+        return iter(passed)
+
+
+class Instrumentation(object):
+    """Timings and recent decisions of the BCPC filters and weighers.
+
+    Every plugin call is added to a latency histogram of the plugin, and a
+    summary of the call is appended to a bounded ring of decisions. Both are
+    written as JSON on SIGUSR1. When instrumentation is off, the plugins only
+    test the enabled attribute.
+    """
+
+    # upper bounds of the latency buckets, in seconds
+    buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+               0.05, 0.1, 0.25, 0.5, 1.0)
+
+    def __init__(self):
+        self.enabled = False
+        self._configured = False
+        self._histograms = {}
+        self._decisions = collections.deque()
+        self._top_hosts = 0
+
+    def setup(self):
+        """Enable the instrumentation once the configuration is loaded."""
+        if self._configured:
+            return
+        self._configured = True
+
+        opts = CONF.bcpc_scheduler
+        if not opts.instrumentation:
+            return
+
+        self._decisions = collections.deque(
+            maxlen=opts.instrumentation_decisions)
+        self._top_hosts = opts.instrumentation_top_hosts
+        try:
+            signal.signal(signal.SIGUSR1, self._handle_signal)
+        except ValueError:
+            LOG.warning("Unable to install the SIGUSR1 handler, the BCPC "
+                        "scheduler instrumentation can not be dumped.")
+        self.enabled = True
+
+    def _observe(self, name, start):
+        elapsed = time.monotonic() - start
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            histogram = self._histograms[name] = {
+                'counts': array.array('Q', [0] * (len(self.buckets) + 1)),
+                'sum': 0.0,
+            }
+        histogram['counts'][bisect.bisect_left(self.buckets, elapsed)] += 1
+        histogram['sum'] += elapsed
+        return elapsed
+
+    def record_filter(self, host_filter, spec_obj, hosts, passed, start):
+        name = type(host_filter).__name__
+        elapsed = self._observe(name, start)
+        self._decisions.append({
+            'time': timeutils.utcnow().isoformat(),
+            'plugin': name,
+            'instance_uuid': _instance_uuid(spec_obj),
+            'seconds': elapsed,
+            'hosts': hosts,
+            'passed': passed,
+        })
+
+    def record_weigher(self, weigher, spec_obj, host_states, raw_weights,
+                       start):
+        name = type(weigher).__name__
+        elapsed = self._observe(name, start)
+
+        top = heapq.nlargest(self._top_hosts, range(len(raw_weights)),
+                             key=raw_weights.__getitem__)
+        normalized = list(base_weights.normalize(
+            [raw_weights[i] for i in top], weigher.minval, weigher.maxval))
+        self._decisions.append({
+            'time': timeutils.utcnow().isoformat(),
+            'plugin': name,
+            'instance_uuid': _instance_uuid(spec_obj),
+            'seconds': elapsed,
+            'hosts': len(host_states),
+            'top': [{'host': host_states[i].host,
+                     'raw': raw_weights[i],
+                     'normalized': weight}
+                    for i, weight in zip(top, normalized)],
+        })
+
+    def report(self):
+        """Return the histograms and recent decisions."""
+        histograms = {}
+        for name, histogram in self._histograms.items():
+            cumulative = []
+            count = 0
+            for bucket_count in histogram['counts']:
+                count += bucket_count
+                cumulative.append(count)
+            histograms[name] = {
+                'buckets': [{'le': le, 'count': c} for le, c in zip(
+                    self.buckets + ('+Inf',), cumulative)],
+                'count': count,
+                'sum': histogram['sum'],
+            }
+        return {
+            'histograms': histograms,
+            'decisions': list(self._decisions),
+            'availability_zones': AVAILABILITY_ZONES.counters(),
+            'missing_metrics': METRICS.missing_count,
+        }
+
+    def dump(self, path=None):
+        """Write the report as JSON to path.
+
+        The pid of the process is added to the default path, since the
+        workers forked by nova-scheduler all inherit the signal handler.
+        """
+        if path is None:
+            path = CONF.bcpc_scheduler.instrumentation_dump_path or (
+                os.path.join(CONF.state_path, 'bcpc_scheduler_trace.json'))
+            root, ext = os.path.splitext(path)
+            path = '%s.%d%s' % (root, os.getpid(), ext)
+        if not self._histograms:
+            LOG.info("No BCPC scheduler instrumentation recorded by this "
+                     "process, nothing written to %s", path)
+            return
+
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        os.replace(tmp_path, path)
+        LOG.info("BCPC scheduler instrumentation written to %s", path)
+
+    def _handle_signal(self, signum, frame):
+        try:
+            self.dump()
+        except (IOError, OSError) as e:
+            LOG.warning("Unable to write the BCPC scheduler "
+                        "instrumentation: %s", e)
+
+
+def _instance_uuid(spec_obj):
+    if 'instance_uuid' in spec_obj:
+        return spec_obj.instance_uuid
+    return None
+
+
+INSTRUMENTATION = Instrumentation()
+
+
+class MetricsIndex(object):
+    """Index of the compute node metrics of every HostState by name.
+
+    HostState replaces its metrics list whenever the compute node is
+    refreshed, so an index is rebuilt only when the list it was built from is
+    no longer the one attached to the host. Lookups of an indexed host are a
+    dict hit and allocate nothing.
+
+    Hosts missing a metric are counted instead of being logged on every
+    request; a warning is only logged when a host starts missing a metric.
+    """
+
+    def __init__(self):
+        self._indexes = weakref.WeakKeyDictionary()
+        self._missing_hosts = {}
+        self.missing_count = 0
+
+    def _index(self, host_state):
+        metrics = host_state.metrics
+        cached = self._indexes.get(host_state)
+        if cached is not None and cached[0] is metrics:
+            return cached[1]
+
+        # to_dict() scales the percentages back to [0, 1] like the
+        # MonitorMetricList.to_list() the metrics used to be read from
+        index = {}
+        for metric in metrics or []:
+            index[metric.name] = (
+                metric.to_dict().get('value'), metric.timestamp)
+
+        self._indexes[host_state] = (metrics, index)
+        return index
+
+    def get_sample(self, host_state, name):
+        """Return the (value, timestamp) of the metric name, or None."""
+        index = self._index(host_state)
+        try:
+            sample = index[name]
+        except KeyError:
+            self._record_missing(host_state.host, name)
+            return None
+
+        missing_hosts = self._missing_hosts.get(name)
+        if missing_hosts and host_state.host in missing_hosts:
+            missing_hosts.discard(host_state.host)
+        return sample
+
+    def get(self, host_state, name, default=None):
+        """Return the value of the metric name reported by a host."""
+        sample = self.get_sample(host_state, name)
+        return default if sample is None else sample[0]
+
+    def _record_missing(self, host, name):
+        self.missing_count += 1
+        missing_hosts = self._missing_hosts.setdefault(name, set())
+        if host not in missing_hosts:
+            missing_hosts.add(host)
+            LOG.warning("Host %s has `%s` missing.", host, name)
+
+    def missing_hosts(self, name):
+        """Return the number of hosts currently missing the metric name."""
+        return len(self._missing_hosts.get(name, ()))
+
+
+METRICS = MetricsIndex()
+
+
+class SampleStore(object):
+    """Smoothed time series of one metric for every host.
+
+    Each host gets a slot holding an exponentially weighted moving average
+    and a ring buffer of its last samples. The slots are laid out in flat
+    arrays, so the memory used is bounded by (window + 3) doubles per host.
+
+    The slots of hosts without a sample for max_age seconds, such as hosts
+    removed from the cloud, are reused for new hosts, so only the hosts
+    sampled recently are held.
+    """
+
+    def __init__(self, window, alpha, max_age=3600):
+        self.window = window
+        self.alpha = alpha
+        self.max_age = max_age
+        self._slots = {}
+        self._free = []
+        self._evicted = time.monotonic()
+        self._ewma = array.array('d')
+        self._timestamps = array.array('d')
+        self._counts = array.array('Q')
+        self._samples = array.array('d')
+
+    def _slot(self, host):
+        slot = self._slots.get(host)
+        if slot is not None:
+            return slot
+
+        # look for stale hosts at most once per max_age, not for every
+        # new host when the scheduler starts
+        now = time.monotonic()
+        if not self._free and now - self._evicted >= self.max_age:
+            self._evicted = now
+            self._evict()
+
+        if self._free:
+            slot = self._free.pop()
+            self._counts[slot] = 0
+            self._timestamps[slot] = -1.0
+        else:
+            slot = len(self._ewma)
+            self._ewma.append(0.0)
+            self._timestamps.append(-1.0)
+            self._counts.append(0)
+            self._samples.extend([0.0] * self.window)
+        self._slots[host] = slot
+        return slot
+
+    def _evict(self):
+        """Free the slots of the hosts without a sample for max_age."""
+        oldest = time.time() - self.max_age
+        for host, slot in list(self._slots.items()):
+            if self._timestamps[slot] < oldest:
+                self.forget(host)
+
+    def add(self, host, value, timestamp=None):
+        """Record a sample, ignoring one already seen for its timestamp."""
+        slot = self._slot(host)
+        if timestamp is not None:
+            # metric timestamps are naive UTC datetimes
+            timestamp = timeutils.normalize_time(timestamp).replace(
+                tzinfo=datetime.timezone.utc).timestamp()
+            if self._timestamps[slot] == timestamp:
+                return
+        else:
+            timestamp = time.time()
+        self._timestamps[slot] = timestamp
+
+        count = self._counts[slot]
+        if count == 0:
+            self._ewma[slot] = value
+        else:
+            self._ewma[slot] += self.alpha * (value - self._ewma[slot])
+        self._samples[slot * self.window + count % self.window] = value
+        self._counts[slot] = count + 1
+
+    def ewma(self, host):
+        """Return the moving average of a host, or None without samples."""
+        slot = self._slots.get(host)
+        if slot is None or self._counts[slot] == 0:
+            return None
+        return self._ewma[slot]
+
+    def percentile(self, host, percentile):
+        """Return a nearest-rank percentile of the window of a host."""
+        slot = self._slots.get(host)
+        if slot is None or self._counts[slot] == 0:
+            return None
+
+        size = min(self._counts[slot], self.window)
+        start = slot * self.window
+        samples = sorted(self._samples[start:start + size])
+        rank = max(int(-(-percentile * size // 100)), 1)
+        return samples[rank - 1]
+
+    def forget(self, host):
+        """Drop the samples of a host and free its slot for another."""
+        slot = self._slots.pop(host, None)
+        if slot is not None:
+            self._free.append(slot)
+
+
+class AvailabilityZoneMap(object):
+    """Map of every compute host to its availability zone.
+
+    The map is built in bulk from the aggregates with an availability_zone
+    metadata, the way nova.availability_zones.get_host_availability_zone
+    resolves a single host, so a lookup is a dict hit instead of a database
+    query. It is built again once availability_zone_map_ttl expired or when
+    the aggregates of a candidate HostState, which the HostManager updates
+    with every aggregate change relayed to the scheduler, tell that the zone
+    of the host changed. Such a rebuild happens at most once per
+    REBUILD_INTERVAL, so a disagreement the rebuild does not fix does not
+    query the aggregates for every candidate.
+    """
+
+    REBUILD_INTERVAL = 10
+
+    def __init__(self):
+        self._zones = None
+        self._aggregates = None
+        self._built = 0
+        self._expires = 0
+        self._admin_context = None
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.invalidations = 0
+
+    def invalidate(self):
+        self._zones = None
+
+    def _get_aggregates(self):
+        """Return the aggregates with an availability_zone metadata."""
+        if self._admin_context is None:
+            self._admin_context = context.get_admin_context()
+        return objects.AggregateList.get_by_metadata_key(
+            self._admin_context, 'availability_zone')
+
+    def _refresh(self):
+        aggregates = self._get_aggregates()
+        zones = {}
+        zone_aggregates = collections.defaultdict(set)
+        for aggregate in aggregates:
+            zone = aggregate.metadata['availability_zone']
+            zone_aggregates[zone].add(aggregate.uuid)
+            for host in aggregate.hosts:
+                zones.setdefault(host, zone)
+
+        self._zones = zones
+        self._aggregates = zone_aggregates
+        self.generation += 1
+        self._built = time.monotonic()
+        self._expires = (self._built +
+                         CONF.bcpc_scheduler.availability_zone_map_ttl)
+        self.refreshes += 1
+        LOG.debug("Availability zone map built for %(hosts)d hosts "
+                  "(%(counters)s)",
+                  {'hosts': len(zones), 'counters': self.counters()})
+
+    def _lookup(self):
+        if self._zones is None or time.monotonic() >= self._expires:
+            self._refresh()
+
+    def get(self, host):
+        """Return the availability zone of host."""
+        self._lookup()
+        zone = self._zones.get(host)
+        if zone is None:
+            self.misses += 1
+            return CONF.default_availability_zone
+        self.hits += 1
+        return zone
+
+    def host_state_zone(self, host_state):
+        """Return the availability zone of a candidate host.
+
+        The zone is read from the aggregates of the HostState. When the map
+        disagrees, it is invalidated unless it was built less than
+        REBUILD_INTERVAL seconds ago, so the zones of the server group
+        members are resolved from the changed aggregates too.
+        """
+        zones = {aggregate.metadata['availability_zone']
+                 for aggregate in host_state.aggregates
+                 if 'availability_zone' in aggregate.metadata}
+        zone = self.get(host_state.host)
+        if zone in zones or (not zones and
+                             zone == CONF.default_availability_zone):
+            return zone
+
+        if time.monotonic() - self._built >= self.REBUILD_INTERVAL:
+            LOG.debug("Availability zone of host %s changed, rebuilding the "
+                      "availability zone map", host_state.host)
+            self.invalidations += 1
+            self.invalidate()
+        return min(zones) if zones else CONF.default_availability_zone
+
+    def aggregates(self, zone):
+        """Return the UUIDs of the aggregates defining zone."""
+        self._lookup()
+        return self._aggregates.get(zone, set())
+
+    def counters(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'refreshes': self.refreshes,
+                'invalidations': self.invalidations}
+
+
+AVAILABILITY_ZONES = AvailabilityZoneMap()
+
+
+def availability_zone_anti_affinity(spec_obj, policies):
+    """Whether a request asks for AZ anti-affinity with one of policies.
+
+    AZ anti-affinity is requested with the anti_affinity_policy scheduler hint
+    set to availability_zone, on a server group with one of policies.
+    """
+    instance_group = spec_obj.instance_group
+    policy = instance_group.policy if instance_group else None
+    az_hint = spec_obj.get_scheduler_hint('anti_affinity_policy', None)
+    return policy in policies and az_hint == 'availability_zone'
+
+
+class GroupAvailabilityZones(object):
+    """Number of members of the server group of a request in each AZ.
+
+    The counts are computed once per request and shared by the AZ
+    anti-affinity filter and weigher for every candidate host. They are
+    computed again for a new request spec, when the members of the group
+    changed, e.g. after an instance of a multi-instance request was placed,
+    or when the availability zone map was built again.
+    """
+
+    def __init__(self):
+        self._request = None
+        self._group_hosts = None
+        self._generation = None
+        self._counts = None
+
+    def get(self, spec_obj):
+        """Return a Counter of the group members per availability zone."""
+        instance_group = spec_obj.instance_group
+        group_hosts = instance_group.hosts if instance_group else []
+
+        request = self._request() if self._request is not None else None
+        if (request is not spec_obj or self._group_hosts != group_hosts or
+                self._generation != AVAILABILITY_ZONES.generation):
+            self._counts = collections.Counter(
+                AVAILABILITY_ZONES.get(host) for host in group_hosts)
+            self._request = weakref.ref(spec_obj)
+            self._group_hosts = list(group_hosts)
+            self._generation = AVAILABILITY_ZONES.generation
+        return self._counts
+
+
+GROUP_AVAILABILITY_ZONES = GroupAvailabilityZones()
+
+
+@request_filter.trace_request_filter
+def az_anti_affinity_prefilter(ctxt, request_spec):
+    """Keep the zones a server group is in out of the placement query.
+
+    The aggregates defining the availability zones of the members of an AZ
+    anti-affinity server group are forbidden to placement. Move operations
+    are left to the AntiAffinityAvailabilityZoneFilter since it lets an
+    instance stay on its source host, in a zone the group is in.
+    """
+    if not CONF.bcpc_scheduler.az_anti_affinity_prefilter:
+        return False
+
+    if not availability_zone_anti_affinity(request_spec, ('anti-affinity',)):
+        return False
+
+    # Nova restricts every move operation to the cell of the instance
+    destination = None
+    if 'requested_destination' in request_spec:
+        destination = request_spec.requested_destination
+    if destination and 'cell' in destination and destination.cell:
+        return False
+
+    forbidden = set()
+    for zone in GROUP_AVAILABILITY_ZONES.get(request_spec):
+        forbidden |= AVAILABILITY_ZONES.aggregates(zone)
+    if not forbidden:
+        return True
+
+    if destination is None:
+        destination = objects.Destination()
+        request_spec.requested_destination = destination
+    destination.append_forbidden_aggregates(forbidden)
+    LOG.debug('az_anti_affinity_prefilter request filter forbade '
+              'aggregates %s', ','.join(sorted(forbidden)))
+    return True
+
+
+class LicenseTraits(object):
+    """License traits of the images, read from license_traits_file.
+
+    The traits are kept in a frozenset, and the file is only read again once
+    its modification time changed, so licenses can be added or removed
+    without restarting the scheduler.
+    """
+
+    def __init__(self):
+        self._path = None
+        self._mtime = None
+        self._traits = frozenset()
+
+    def _load(self, path):
+        with open(path) as f:
+            return frozenset(
+                line.strip() for line in f
+                if line.strip() and not line.startswith('#'))
+
+    def get(self):
+        """Return the frozenset of license traits."""
+        path = CONF.bcpc_scheduler.license_traits_file
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            if path != self._path or mtime != self._mtime:
+                self._traits = self._load(path)
+                self._path, self._mtime = path, mtime
+                LOG.info("Loaded %(count)d license traits from %(path)s",
+                         {'count': len(self._traits), 'path': path})
+        except OSError as e:
+            if self._mtime is not None or self._path != path:
+                LOG.warning("Unable to read the license traits from "
+                            "%(path)s: %(error)s", {'path': path, 'error': e})
+            self._path, self._mtime = path, None
+            self._traits = frozenset()
+        return self._traits
+
+
+LICENSE_TRAITS = LicenseTraits()
+
+
+def image_license_traits(spec_obj):
+    """Return the license traits required by the image of a request."""
+    license_traits = LICENSE_TRAITS.get()
+    image_props = spec_obj.image.properties if spec_obj.image else {}
+    traits_required = image_props.get('traits_required', [])
+    return [t for t in traits_required if t in license_traits]
+
+
+@request_filter.trace_request_filter
+def license_traits_prefilter(ctxt, request_spec):
+    """Require the license trait of the image on the compute node.
+
+    Nova already requires the traits of the image from placement. Images have
+    to require exactly one license trait though, which the
+    RequiredImagePropertyFilter otherwise checks against every host.
+    """
+    if not CONF.bcpc_scheduler.license_traits_prefilter:
+        return False
+
+    license_traits = image_license_traits(request_spec)
+    # match on exactly one licensing trait.
+    if len(license_traits) != 1:
+        raise exception.RequestFilterFailed(
+            reason='image requires %d license traits instead of one' %
+            len(license_traits))
+
+    request_spec.root_required.add(license_traits[0])
+    LOG.debug('license_traits_prefilter request filter added required '
+              'trait %s', license_traits[0])
+    return True
+
+
+# Request filters are not pluggable, the scheduler runs every function of
+# ALL_REQUEST_FILTERS on a request spec before querying placement.
+for _request_filter in (az_anti_affinity_prefilter, license_traits_prefilter):
+    if _request_filter not in request_filter.ALL_REQUEST_FILTERS:
+        request_filter.ALL_REQUEST_FILTERS.append(_request_filter)
@@ -17,13 +17,15 @@
 #    under the License.
 
 
-from nova.scheduler import filters
+import weakref
+
+from nova.scheduler import bcpc_utils
 from oslo_log import log as logging
 
 LOG = logging.getLogger(__name__)
 
 
-class RequiredImagePropertyFilter(filters.BaseHostFilter):
+class RequiredImagePropertyFilter(bcpc_utils.BaseBCPCFilter):
     """Filters compute nodes with provided image required traits."""
 
     # a rebuild can be issued against a new image
@@ -31,24 +33,31 @@ class RequiredImagePropertyFilter(filters.BaseHostFilter):
     # image Properties do not change within a request
     run_filter_once_per_request = True
 
+    def __init__(self):
+        super(RequiredImagePropertyFilter, self).__init__()
+        # license traits required by the image of the last request
+        self._request = None
+        self._filtered_traits = None
+
+    def _get_filtered_traits(self, spec_obj):
+        """Return the license traits required by the image of the request.
+
+        The traits only depend on the image, so they are matched once per
+        request instead of once per host.
+        """
+        request = self._request() if self._request is not None else None
+        if request is not spec_obj:
+            self._filtered_traits = bcpc_utils.image_license_traits(spec_obj)
+            self._request = weakref.ref(spec_obj)
+            LOG.debug("required image property filter: matched traits "
+                      "%(traits)s", {'traits': self._filtered_traits})
+        return self._filtered_traits
+
     def host_passes(self, host_state, spec_obj):
         """Checks a host provides required image traits.
+
         Passes if the host provides required traits by the image,
         otherwise filtered out.
         """
-        bcc_image_traits = [
-            <%= @license_traits.join(",\n            ") %>
-        ]
-
-        image_props = spec_obj.image.properties if spec_obj.image else {}
-        traits_required = image_props.get('traits_required', [])
-
         # match on exactly one licensing trait.
-        filtered_traits = [t for t in traits_required if t in bcc_image_traits]
-        LOG.debug("required image property filter: host %(host)s is filtered "
-                  "with image properties %(image)s on matched traits "
-                  "%(traits)s",
-                  {'host': host_state.host,
-                   'image': traits_required,
-                   'traits': filtered_traits})
-        return len(filtered_traits) == 1
+        return len(self._get_filtered_traits(spec_obj)) == 1
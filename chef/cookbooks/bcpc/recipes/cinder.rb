@@ -195,6 +195,37 @@ if zone_config.enabled?
   end
 end
 
+# add BCPC backend weigher and update cinder entry_points.txt
+if node['bcpc']['cinder']['weigher']['backend']['enabled']
+  cookbook_file '/usr/lib/python3/dist-packages/cinder/scheduler/weights/bcpc_backend_weigher.py' do
+    source 'cinder/bcpc_backend_weigher.py'
+    notifies :run, 'execute[compile bcpc backend weigher]', :immediately
+    notifies :restart, 'service[cinder-scheduler]', :delayed
+  end
+
+  execute 'compile bcpc backend weigher' do
+    action :nothing
+    command 'py3compile /usr/lib/python3/dist-packages/cinder/scheduler/weights/bcpc_backend_weigher.py'
+  end
+
+  bash 'add BCPCBackendWeigher to cinder' do
+    code <<-EOH
+      entry_points_txt=$(dpkg -L python3-cinder | grep entry_points.txt)
+
+      if [ -z ${entry_points_txt} ]; then
+        echo "entry_points.txt file path could not be found"
+        exit 1
+      fi
+
+      if ! grep BCPCBackendWeigher ${entry_points_txt}; then
+        # update entry points file using crudini
+        crudini --set ${entry_points_txt} cinder.scheduler.weights \
+          BCPCBackendWeigher cinder.scheduler.weights.bcpc_backend_weigher:BCPCBackendWeigher
+      fi
+    EOH
+  end
+end
+
 # lay down cinder configuration files
 cookbook_file '/etc/cinder/api-paste.ini' do
   source 'cinder/api-paste.ini'
@@ -195,18 +195,19 @@ aggregate_image =
 if required_image['enabled']
   available_filters.push(required_image['filterPath'])
   enabled_filters += [aggregate_image['name'], required_image['name']]
-  license_traits = node['bcpc']['license_traits']['traits'].map { |t| "\'#{t['trait']}\'" }
+  license_traits = node['bcpc']['license_traits']['traits'].map { |t| t['trait'] }
 
-  template '/usr/lib/python3/dist-packages/nova/scheduler/filters/required_image_property_filter.py' do
-    source 'nova/required_image_property_filter.py.erb'
+  # read again by the filter whenever it changes
+  file required_image['license_traits_file'] do
+    content "#{license_traits.join("\n")}\n"
     mode '0644'
     owner 'root'
-    group 'root'
-
-    variables(
-      license_traits: license_traits
-    )
+    group 'nova'
+  end
 
+  cookbook_file '/usr/lib/python3/dist-packages/nova/scheduler/filters/required_image_property_filter.py' do
+    source 'nova/required_image_property_filter.py'
+    mode '0644'
     notifies :run, 'execute[compile required-image-property filter]', :immediately
     notifies :restart, 'service[nova-scheduler]', :delayed
   end
@@ -217,6 +218,13 @@ if required_image['enabled']
   end
 end
 
+# helpers shared by the BCPC scheduler filters and weighers
+cookbook_file '/usr/lib/python3/dist-packages/nova/scheduler/bcpc_utils.py' do
+  source 'nova/bcpc_utils.py'
+  notifies :run, 'execute[py3compile-nova]', :immediately
+  notifies :restart, 'service[nova-scheduler]', :delayed
+end
+
 # not-yet-upstreamed bugfixes for the CPU and RAM weighers
 cookbook_file '/usr/lib/python3/dist-packages/nova/scheduler/weights/bcpc_cpu.py' do
   source 'nova/bcpc_cpu.py'
@@ -230,6 +238,53 @@ cookbook_file '/usr/lib/python3/dist-packages/nova/scheduler/weights/bcpc_ram.py
   notifies :restart, 'service[nova-scheduler]', :delayed
 end
 
+# add NUMA-aware scheduler weigher
+weight_classes = node['bcpc']['nova']['scheduler_weight_classes']
+numa_weigher = node['bcpc']['nova']['scheduler']['weigher']['numa']
+
+cookbook_file '/usr/lib/python3/dist-packages/nova/scheduler/weights/bcpc_numa.py' do
+  source 'nova/bcpc_numa.py'
+  notifies :run, 'execute[py3compile-nova]', :immediately
+  notifies :restart, 'service[nova-scheduler]', :delayed
+end
+
+if numa_weigher['enabled']
+  weight_classes += [numa_weigher['weigherPath']]
+end
+
+# add dominant resource share scheduler weigher
+resource_weigher = node['bcpc']['nova']['scheduler']['weigher']['resource']
+
+cookbook_file '/usr/lib/python3/dist-packages/nova/scheduler/weights/bcpc_resource.py' do
+  source 'nova/bcpc_resource.py'
+  notifies :run, 'execute[py3compile-nova]', :immediately
+  notifies :restart, 'service[nova-scheduler]', :delayed
+end
+
+if resource_weigher['enabled']
+  weight_classes -= resource_weigher['replaces']
+  weight_classes += [resource_weigher['weigherPath']]
+end
+
+# add availability zone anti-affinity scheduler weigher
+az_weigher = node['bcpc']['nova']['scheduler']['weigher']['anti_affinity_availability_zone']
+
+cookbook_file '/usr/lib/python3/dist-packages/nova/scheduler/weights/anti_affinity_availability_zone_weigher.py' do
+  source 'nova/anti_affinity_availability_zone_weigher.py'
+  notifies :run, 'execute[py3compile-nova]', :immediately
+  notifies :restart, 'service[nova-scheduler]', :delayed
+end
+
+if az_weigher['enabled']
+  weight_classes += [az_weigher['weigherPath']]
+end
+
+# offline replay simulator and benchmark of the BCPC scheduler plugins
+cookbook_file '/usr/local/bin/bcpc-scheduler-simulator' do
+  source 'nova/bcpc_scheduler_simulator.py'
+  mode '755'
+end
+
 execute 'py3compile-nova' do
   action :nothing
   command 'py3compile -p python3-nova'
@@ -327,6 +382,7 @@ template '/etc/nova/nova.conf' do
   variables(
     available_filters: available_filters,
     enabled_filters: enabled_filters,
+    weight_classes: weight_classes,
     db: database,
     os: openstack,
     config: config,